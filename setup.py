@@ -22,6 +22,9 @@ setup(
         "matplotlib",
         "geopandas",
     ],
+    extras_require={
+        "zarr": ["zarr"],
+    },
     long_description=open("README.md").read(),
     long_description_content_type="text/markdown",
     url="https://github.com/iharp3/iharp-vector-predicate",
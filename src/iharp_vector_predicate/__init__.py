@@ -1,4 +1,5 @@
 from .query_executor import QueryExecutor
+from .query_executor_batch import BatchExecutor
 from .query_executor_find_area import FindAreaExecutor
 from .query_executor_find_time import FindTimeExecutor
 from .query_executor_geojson import GeoJsonExecutor
@@ -1,8 +1,13 @@
+import os
+
 import numpy as np
 import pandas as pd
 import xarray as xr
 
-from .utils.const import get_lat_lon_range, time_resolution_to_freq
+from .utils.const import get_lat_lon_index_range, get_lat_lon_range, time_resolution_to_freq
+
+# metadata columns bounding the data of a file, in the order of a (time, latitude, longitude) box
+ROW_BOX_COLUMNS = ["start_datetime", "end_datetime", "min_lat", "max_lat", "min_lon", "max_lon"]
 
 
 def gen_empty_xarray(
@@ -16,12 +21,11 @@ def gen_empty_xarray(
     spatial_resolution,
 ):
     lat_range, lon_range, lat_range_reverse = get_lat_lon_range(spatial_resolution)
-    lat_start = lat_range.searchsorted(min_lat, side="left")
-    lat_end = lat_range.searchsorted(max_lat, side="right")
+    lat_start, lat_end, lon_start, lon_end = get_lat_lon_index_range(
+        spatial_resolution, min_lat, max_lat, min_lon, max_lon
+    )
     lat_reverse_start = len(lat_range) - lat_end
     lat_reverse_end = len(lat_range) - lat_start
-    lon_start = lon_range.searchsorted(min_lon, side="left")
-    lon_end = lon_range.searchsorted(max_lon, side="right")
     ds_empty = xr.Dataset()
     ds_empty["time"] = pd.date_range(
         start=start_datetime,
@@ -33,37 +37,168 @@ def gen_empty_xarray(
     return ds_empty
 
 
-class Metadata:
-    def __init__(self, f_path):
-        self.f_path = f_path
-        self.df_meta = pd.read_csv(f_path)
+class TimeAxis:
+    """
+    Query time labels, as pd.date_range(start, end, freq) would generate them, addressed by index.
+    Hourly and daily axes are handled arithmetically and never materialized.
+    """
+
+    FIXED_STEPS = {"hour": pd.Timedelta(hours=1), "day": pd.Timedelta(days=1)}
 
-    @staticmethod
-    def _gen_xarray_for_meta_row(row, overwrite_temporal_resolution=None):
-        if overwrite_temporal_resolution is not None:
-            t_resolution = overwrite_temporal_resolution
+    def __init__(self, start_datetime, end_datetime, temporal_resolution):
+        self.start = pd.Timestamp(start_datetime)
+        end = pd.Timestamp(end_datetime)
+        self.step = self.FIXED_STEPS.get(temporal_resolution)
+        if self.step is not None:
+            self.labels = None
+            self.size = max(0, (end - self.start) // self.step + 1)
         else:
-            t_resolution = row.temporal_resolution
-        return gen_empty_xarray(
-            row.min_lat,
-            row.max_lat,
-            row.min_lon,
-            row.max_lon,
-            row.start_datetime,
-            row.end_datetime,
-            t_resolution,
-            row.spatial_resolution,
+            self.labels = pd.date_range(self.start, end, freq=time_resolution_to_freq(temporal_resolution))
+            self.size = len(self.labels)
+
+    def label(self, i):
+        if self.labels is not None:
+            return self.labels[i]
+        return self.start + i * self.step
+
+    def index_range(self, start_datetime, end_datetime):
+        """
+        Return: half-open index range of the labels also generated by pd.date_range(start, end, freq)
+        """
+        start = pd.Timestamp(start_datetime)
+        end = pd.Timestamp(end_datetime)
+        if self.labels is not None:
+            if start - start.normalize() != self.start - self.start.normalize():
+                # calendar labels keep the time of day of their start, no label in common
+                return 0, 0
+            return self.labels.searchsorted(start, side="left"), self.labels.searchsorted(end, side="right")
+        if (start - self.start) % self.step != pd.Timedelta(0):
+            # grid of the other range is shifted against this axis, no label in common
+            return 0, 0
+        lo = max(0, -((self.start - start) // self.step))
+        hi = min(self.size, (end - self.start) // self.step + 1)
+        return lo, max(lo, hi)
+
+
+def subtract_box(box, cut):
+    """
+    Box: ((start, end), ...) half-open index ranges per dimension
+    Return: list of disjoint boxes covering box minus cut
+    """
+    if any(c_end <= b_start or c_start >= b_end for (b_start, b_end), (c_start, c_end) in zip(box, cut)):
+        return [box]
+    pieces = []
+    rest = list(box)
+    for dim, ((b_start, b_end), (c_start, c_end)) in enumerate(zip(box, cut)):
+        if b_start < c_start:
+            pieces.append(tuple(rest[:dim] + [(b_start, c_start)] + rest[dim + 1 :]))
+        if c_end < b_end:
+            pieces.append(tuple(rest[:dim] + [(c_end, b_end)] + rest[dim + 1 :]))
+        rest[dim] = (max(b_start, c_start), min(b_end, c_end))
+    return pieces
+
+
+def _to_epoch_ns(values):
+    return pd.to_datetime(values).values.astype("datetime64[ns]").astype(np.int64)
+
+
+class MetadataIndex:
+    """
+    Packed R-tree over metadata rows, one per (variable, temporal_resolution, spatial_resolution, aggregation).
+
+    Rows are bulk-loaded with Sort-Tile-Recursive: ordered into slabs by time, then latitude, then longitude,
+    and packed NODE_CAPACITY per leaf; every upper level packs NODE_CAPACITY nodes of the level below.
+    Each node keeps the bounding box of its children, time as int64 ns and lat/lon as float.
+    A query descends level by level, testing the children of the nodes it overlaps only.
+    """
+
+    PARTITION_COLUMNS = ["variable", "temporal_resolution", "spatial_resolution", "aggregation"]
+    NODE_CAPACITY = 16
+
+    def __init__(self, df_meta):
+        times = np.stack([_to_epoch_ns(df_meta["start_datetime"]), _to_epoch_ns(df_meta["end_datetime"])], axis=1)
+        bounds = df_meta[["min_lat", "max_lat", "min_lon", "max_lon"]].to_numpy(dtype=np.float64)
+        self.partitions = {}
+        if len(df_meta) == 0:
+            return
+        for key, positions in df_meta.groupby(self.PARTITION_COLUMNS, sort=False).indices.items():
+            order = positions[self._str_order(times[positions], bounds[positions])]
+            # levels[0]: the rows; levels[i]: bounding boxes of NODE_CAPACITY consecutive entries of levels[i - 1]
+            levels = [(times[order], bounds[order])]
+            while len(levels[-1][0]) > 1:
+                levels.append(self._pack(*levels[-1]))
+            self.partitions[key] = {"positions": order, "levels": levels}
+
+    @classmethod
+    def _str_order(cls, times, bounds):
+        """
+        Return: Sort-Tile-Recursive order of boxes, so that NODE_CAPACITY consecutive ones are close in all dimensions
+        """
+        centers = np.stack(
+            [
+                (times[:, 0] + (times[:, 1] - times[:, 0]) // 2).astype(np.float64),
+                (bounds[:, 0] + bounds[:, 1]) / 2,
+                (bounds[:, 2] + bounds[:, 3]) / 2,
+            ],
+            axis=1,
         )
+        slabs = max(1, int(np.ceil(np.ceil(len(centers) / cls.NODE_CAPACITY) ** (1 / 3))))
 
-    @staticmethod
-    def _mask_query_with_meta(ds_query, ds_meta):
+        def order(index, dim):
+            index = index[np.argsort(centers[index, dim], kind="stable")]
+            if dim == centers.shape[1] - 1:
+                return index
+            slab_size = int(np.ceil(len(index) / slabs))
+            return np.concatenate([order(index[i : i + slab_size], dim + 1) for i in range(0, len(index), slab_size)])
+
+        return order(np.arange(len(centers)), 0)
+
+    @classmethod
+    def _pack(cls, times, bounds):
+        starts = np.arange(0, len(times), cls.NODE_CAPACITY)
         return (
-            ds_query["time"].isin(ds_meta["time"])
-            & ds_query["latitude"].isin(ds_meta["latitude"])
-            & ds_query["longitude"].isin(ds_meta["longitude"])
+            np.stack([np.minimum.reduceat(times[:, 0], starts), np.maximum.reduceat(times[:, 1], starts)], axis=1),
+            np.stack(
+                [
+                    np.minimum.reduceat(bounds[:, 0], starts),
+                    np.maximum.reduceat(bounds[:, 1], starts),
+                    np.minimum.reduceat(bounds[:, 2], starts),
+                    np.maximum.reduceat(bounds[:, 3], starts),
+                ],
+                axis=1,
+            ),
         )
 
-    def query_get_overlap_and_leftover(
+    def _search(self, part, q_start, q_end, min_lat, max_lat, min_lon, max_lon):
+        """
+        Return: (indices into the partition's rows overlapping the query box, number of boxes tested)
+        """
+        levels = part["levels"]
+        candidates = np.arange(len(levels[-1][0]))
+        tested = 0
+        for depth in range(len(levels) - 1, -1, -1):
+            times, bounds = levels[depth]
+            times, bounds = times[candidates], bounds[candidates]
+            tested += len(candidates)
+            hit = (
+                (times[:, 0] <= q_end)
+                & (times[:, 1] >= q_start)
+                & (bounds[:, 0] <= max_lat)
+                & (bounds[:, 1] >= min_lat)
+                & (bounds[:, 2] <= max_lon)
+                & (bounds[:, 3] >= min_lon)
+            )
+            candidates = candidates[hit]
+            if depth == 0 or len(candidates) == 0:
+                break
+            # children of every overlapping node: NODE_CAPACITY consecutive entries of the level below
+            n_children = len(levels[depth - 1][0])
+            first = candidates * self.NODE_CAPACITY
+            counts = np.minimum(first + self.NODE_CAPACITY, n_children) - first
+            candidates = np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return candidates, tested
+
+    def query(
         self,
         variable,
         start_datetime,
@@ -76,54 +211,111 @@ class Metadata:
         spatial_resolution,
         aggregation,
     ):
-        df_overlap = self.df_meta[
-            (self.df_meta["variable"] == variable)
-            & (self.df_meta["min_lat"] <= max_lat)
-            & (self.df_meta["max_lat"] >= min_lat)
-            & (self.df_meta["min_lon"] <= max_lon)
-            & (self.df_meta["max_lon"] >= min_lon)
-            & (pd.to_datetime(self.df_meta["start_datetime"]) <= pd.to_datetime(end_datetime))
-            & (pd.to_datetime(self.df_meta["end_datetime"]) >= pd.to_datetime(start_datetime))
-            & (self.df_meta["temporal_resolution"] == temporal_resolution)
-            & (self.df_meta["spatial_resolution"] == spatial_resolution)
-            & (self.df_meta["aggregation"] == aggregation)
-        ]
-
-        ds_query = gen_empty_xarray(
+        """
+        Return: sorted row positions (into df_meta) overlapping the query
+        """
+        part = self.partitions.get((variable, temporal_resolution, spatial_resolution, aggregation))
+        if part is None:
+            return np.empty(0, dtype=np.int64)
+        hits, _ = self._search(
+            part,
+            pd.Timestamp(start_datetime).value,
+            pd.Timestamp(end_datetime).value,
             min_lat,
             max_lat,
             min_lon,
             max_lon,
+        )
+        return np.sort(part["positions"][hits])
+
+
+class Metadata:
+    def __init__(self, f_path):
+        self.f_path = f_path
+        self.mtime = os.path.getmtime(f_path)
+        self.df_meta = pd.read_csv(f_path)
+        self.index = MetadataIndex(self.df_meta)
+
+    def query_get_overlap_and_leftover(
+        self,
+        variable,
+        start_datetime,
+        end_datetime,
+        min_lat,
+        max_lat,
+        min_lon,
+        max_lon,
+        temporal_resolution,
+        spatial_resolution,
+        aggregation,
+    ):
+        """
+        Return: (overlapping metadata rows, leftover)
+            leftover is None when the rows cover the query, otherwise a list of uncovered
+            hyperrectangles, each a dict of start/end_datetime and min/max lat/lon (inclusive)
+        """
+        positions = self.index.query(
+            variable,
             start_datetime,
             end_datetime,
+            min_lat,
+            max_lat,
+            min_lon,
+            max_lon,
             temporal_resolution,
             spatial_resolution,
+            aggregation,
         )
+        df_overlap = self.df_meta.iloc[positions]
 
-        false_mask = xr.DataArray(
-            data=np.zeros(
-                (
-                    ds_query.sizes["time"],
-                    ds_query.sizes["latitude"],
-                    ds_query.sizes["longitude"],
-                ),
-                dtype=bool,
-            ),
-            coords={
-                "time": ds_query["time"],
-                "latitude": ds_query["latitude"],
-                "longitude": ds_query["longitude"],
-            },
-            dims=["time", "latitude", "longitude"],
+        time_axis = TimeAxis(start_datetime, end_datetime, temporal_resolution)
+        lat_start, lat_end, lon_start, lon_end = get_lat_lon_index_range(
+            spatial_resolution, min_lat, max_lat, min_lon, max_lon
         )
+        query_box = ((0, time_axis.size), (lat_start, lat_end), (lon_start, lon_end))
+        if any(start >= end for start, end in query_box):
+            return df_overlap, None
 
-        for row in df_overlap.itertuples():
-            ds_meta = self._gen_xarray_for_meta_row(row)
-            mask = self._mask_query_with_meta(ds_query, ds_meta)
-            false_mask = false_mask | mask
+        uncovered = [query_box]
+        # column arrays, row-wise DataFrame iteration dominates the cost of small lookups
+        rows = zip(*(df_overlap[c].to_numpy() for c in ROW_BOX_COLUMNS))
+        for row_start, row_end, row_min_lat, row_max_lat, row_min_lon, row_max_lon in rows:
+            row_lat_start, row_lat_end, row_lon_start, row_lon_end = get_lat_lon_index_range(
+                spatial_resolution, row_min_lat, row_max_lat, row_min_lon, row_max_lon
+            )
+            row_box = (
+                time_axis.index_range(row_start, row_end),
+                (row_lat_start, row_lat_end),
+                (row_lon_start, row_lon_end),
+            )
+            uncovered = [piece for box in uncovered for piece in subtract_box(box, row_box)]
+            if not uncovered:
+                return df_overlap, None
 
-        leftover = false_mask.where(false_mask == False, drop=True)
-        if leftover.values.size > 0:
-            return df_overlap, leftover
-        else:
-            return df_overlap, None
+        lat_range, lon_range, _ = get_lat_lon_range(spatial_resolution)
+        leftover = [
+            {
+                "start_datetime": time_axis.label(t_start),
+                "end_datetime": time_axis.label(t_end - 1),
+                "min_lat": lat_range[l_start].item(),
+                "max_lat": lat_range[l_end - 1].item(),
+                "min_lon": lon_range[o_start].item(),
+                "max_lon": lon_range[o_end - 1].item(),
+            }
+            for (t_start, t_end), (l_start, l_end), (o_start, o_end) in uncovered
+        ]
+        return df_overlap, leftover
+
+
+_metadata_cache = {}
+
+
+def load_metadata(f_path):
+    """
+    Return: Metadata shared by all executors, re-read (and re-indexed) when the file changes
+    """
+    cached = _metadata_cache.get(f_path)
+    if cached is None or cached.mtime != os.path.getmtime(f_path):
+        cached = Metadata(f_path)
+        _metadata_cache[f_path] = cached
+    return cached
@@ -1,8 +1,14 @@
 from abc import ABC, abstractmethod
+import json
+
+import pandas as pd
 import xarray as xr
 
-from .metadata import Metadata
-from .utils.const import long_short_name_dict, NO_AGG_LIT
+from .metadata import load_metadata
+from .utils.const import get_lat_lon_index_range, long_short_name_dict, NO_AGG_LIT
+from .utils.planner import choose_plan, format_plans
+from .utils.result_cache import result_cache
+from .utils.tracing import tracer
 
 
 class QueryExecutor(ABC):
@@ -37,13 +43,114 @@ class QueryExecutor(ABC):
         # query internal variables
         self.variable_short_name = long_short_name_dict[self.variable]
         if metadata:
-            self.metadata = Metadata(metadata)
+            self.metadata = load_metadata(metadata)
         else:
-            self.metadata = Metadata("/data/metadata.csv")
+            self.metadata = load_metadata("/data/metadata.csv")
+        # plan chosen by _get_plans and executors built by _nested_executor, kept for the executor's lifetime
+        self._plans = None
+        self._nested = {}
 
-    @abstractmethod
     def execute(self) -> xr.Dataset:
         """
         Return: xarray.Dataset, with data variable as loaded-in-memory Numpy array
+        Results are served from utils.result_cache when the same normalized query ran before;
+        their arrays are shared with the cache and read-only.
+        Stages are traced (see utils.tracing), the result carries the summary of this call's span
+        as JSON in attrs["trace"]; cached entries are stored without it.
         """
+        with tracer.span("query", executor=type(self).__name__, variable=self.variable) as span:
+            key = self._cache_key()
+            use_result_cache = self._use_result_cache()
+            result = result_cache.get(key) if use_result_cache else None
+            span.set(cache_hit=result is not None)
+            if result is None:
+                result = self._execute()
+                # traces of nested executions may be carried over by xarray operations
+                result.attrs.pop("trace", None)
+                if use_result_cache:
+                    result_cache.put(key, result)
+                    # the cache holds result itself, the trace goes on a copy with its own attrs
+                    result = result.copy(deep=False)
+        result.attrs["trace"] = json.dumps(span.summary())
+        return result
+
+    def _use_result_cache(self):
+        return True
+
+    @abstractmethod
+    def _execute(self) -> xr.Dataset:
         pass
+
+    def _candidate_plans(self):
+        """
+        Return: {plan name: [(GetRasterExecutor, expected fraction of it read)]}, the first plan is the default
+        """
+        return {"default": [(self, 1)]}
+
+    def _get_plans(self):
+        """
+        Return: (name of the candidate plan with the lowest estimated cost, {plan name: reads}, {plan name: estimate})
+            candidates are built and estimated once per executor (see utils.planner)
+        """
+        if self._plans is None:
+            with tracer.span("plan") as span:
+                plans = self._candidate_plans()
+                chosen, estimates = choose_plan(plans)
+                span.set(chosen=chosen)
+            self._plans = (chosen, plans, estimates)
+        return self._plans
+
+    def _choose_plan(self):
+        return self._get_plans()[0]
+
+    def _planned_reads(self):
+        chosen, plans, _ = self._get_plans()
+        return plans[chosen]
+
+    def _nested_executor(self, executor_class, *args, **kwargs):
+        """
+        Return: executor_class(*args, **kwargs), or the one built before by this executor for the same
+            normalized query (see _cache_key), so that an executor planned as part of this one's candidates
+            executes that plan
+        """
+        executor = executor_class(*args, **kwargs)
+        return self._nested.setdefault(executor._cache_key(), executor)
+
+    def explain(self):
+        """
+        Return: str, estimated bytes read and file opens of every candidate plan, the one execute() takes starred;
+            nothing is printed
+        """
+        chosen, _, estimates = self._get_plans()
+        return format_plans(type(self).__name__, chosen, estimates)
+
+    def _cache_params(self):
+        """
+        Return: tuple of the executor-specific parameters that change its result
+        """
+        return ()
+
+    def _cache_key(self):
+        """
+        Query parameters normalized onto the lat/lon grid, so that equivalent queries share one entry
+        """
+        if None in (self.min_lat, self.max_lat, self.min_lon, self.max_lon):
+            grid_box = None
+        else:
+            grid_box = tuple(
+                int(i)
+                for i in get_lat_lon_index_range(
+                    self.spatial_resolution, self.min_lat, self.max_lat, self.min_lon, self.max_lon
+                )
+            )
+        return (
+            (self.metadata.f_path, self.metadata.mtime),
+            type(self).__name__,
+            self.variable,
+            pd.Timestamp(self.start_datetime).isoformat(),
+            pd.Timestamp(self.end_datetime).isoformat(),
+            grid_box,
+            self.temporal_resolution,
+            float(self.spatial_resolution),
+            self.aggregation,
+        ) + tuple(self._cache_params())
@@ -0,0 +1,243 @@
+import json
+
+import dask
+import pandas as pd
+
+from .metadata import TimeAxis, subtract_box
+from .query_executor_find_time import FindTimeExecutor
+from .query_executor_get_raster import GetRasterExecutor
+from .query_executor_timeseries import TimeseriesExecutor
+from .utils.const import get_lat_lon_index_range
+from .utils.result_cache import result_cache
+from .utils.tracing import tracer
+
+# a cluster reads its envelope once only if the envelope holds at most this many times the cells its queries select
+ENVELOPE_MAX_RATIO = 2
+
+
+class BatchExecutor:
+    """
+    Execute a burst of queries, sharing the raster reads of those that overlap.
+
+    TimeseriesExecutor and FindTimeExecutor queries (the latter through their baseline time series)
+    are grouped by the files they read: (metadata, variable, temporal_resolution, aggregation).
+    Within a group, queries overlapping in time and space are clustered, and every cluster reads
+    the envelope of its queries lazily; the reductions of every query's part of it are computed in one pass.
+    A cluster whose envelope is not covered by local files, or is much larger than the union of its
+    queries (see ENVELOPE_MAX_RATIO), reads every query on its own.
+    Queries for which the planner picks another plan than their baseline time series (pushdown, pyramid),
+    and other executors, run on their own. Results are added to utils.result_cache as if each query ran.
+    Queries run on their own carry their own trace in attrs["trace"] (see QueryExecutor.execute),
+    the others the summary of the whole batch's span.
+    """
+
+    def __init__(self, queries):
+        self.queries = list(queries)  # e.g., [TimeseriesExecutor(...), FindTimeExecutor(...)]
+
+    def execute(self):
+        """
+        Return: [xarray.Dataset], one result per query, in query order
+        """
+        with tracer.span("batch", queries=len(self.queries)) as span:
+            results, batched = self._execute()
+        trace = json.dumps(span.summary())
+        for i in batched:
+            results[i].attrs["trace"] = trace
+        return results
+
+    def _execute(self):
+        """
+        Return: ([xarray.Dataset] in query order, indices of the results not returned by the query's own execute())
+        """
+        results = [result_cache.get(q._cache_key()) for q in self.queries]
+        batched = [i for i, result in enumerate(results) if result is not None]
+
+        # time series to compute, deduplicated: {cache key: (TimeseriesExecutor, {method: reduced})}
+        timeseries = {}
+        ts_keys = {}
+        for i, query in enumerate(self.queries):
+            if results[i] is not None:
+                continue
+            if isinstance(query, (TimeseriesExecutor, FindTimeExecutor)) and query._choose_plan() != "baseline":
+                results[i] = query.execute()
+                continue
+            if isinstance(query, TimeseriesExecutor):
+                ts_executor = query
+            elif isinstance(query, FindTimeExecutor):
+                ts_executor = query._get_timeseries_executor(query.start_datetime, query.end_datetime)
+            else:
+                results[i] = query.execute()
+                continue
+            batched.append(i)
+            ts_keys[i] = ts_executor._cache_key()
+            timeseries.setdefault(ts_keys[i], (ts_executor, {}))
+
+        groups = {}
+        for ts_executor, reduced in timeseries.values():
+            for aggregation, methods in ts_executor._get_read_groups().items():
+                key = (ts_executor.metadata.f_path, ts_executor.variable, ts_executor.temporal_resolution, aggregation)
+                groups.setdefault(key, []).append((ts_executor, methods, reduced))
+
+        for (_, _, _, aggregation), members in groups.items():
+            for cluster in self._cluster([ts_executor for ts_executor, _, _ in members]):
+                self._execute_cluster([members[i] for i in cluster], aggregation)
+
+        ts_results = {}
+        for key, (ts_executor, reduced) in timeseries.items():
+            ts_results[key] = ts_executor._assemble(reduced)
+            result_cache.put(key, ts_results[key])
+
+        for i, ts_key in ts_keys.items():
+            query = self.queries[i]
+            if isinstance(query, TimeseriesExecutor):
+                results[i] = ts_results[ts_key].copy(deep=False)
+            else:
+                results[i] = query._apply_predicate(ts_results[ts_key])
+                result_cache.put(query._cache_key(), results[i])
+                results[i] = results[i].copy(deep=False)
+        return results, batched
+
+    @staticmethod
+    def _cluster(executors):
+        """
+        Return: [[index into executors]], groups of executors connected by overlapping time range and bbox
+        """
+        bounds = [
+            (
+                pd.Timestamp(e.start_datetime),
+                pd.Timestamp(e.end_datetime),
+                e.min_lat,
+                e.max_lat,
+                e.min_lon,
+                e.max_lon,
+            )
+            for e in executors
+        ]
+        parent = list(range(len(executors)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for i, (start_i, end_i, min_lat_i, max_lat_i, min_lon_i, max_lon_i) in enumerate(bounds):
+            for j in range(i):
+                start_j, end_j, min_lat_j, max_lat_j, min_lon_j, max_lon_j = bounds[j]
+                if (
+                    start_i <= end_j
+                    and start_j <= end_i
+                    and min_lat_i <= max_lat_j
+                    and min_lat_j <= max_lat_i
+                    and min_lon_i <= max_lon_j
+                    and min_lon_j <= max_lon_i
+                ):
+                    parent[find(i)] = find(j)
+
+        clusters = {}
+        for i in range(len(executors)):
+            clusters.setdefault(find(i), []).append(i)
+        return list(clusters.values())
+
+    @staticmethod
+    def _execute_cluster(members, aggregation):
+        """
+        Read the envelope of members lazily, and compute the reductions of every member's selection of it at once
+        members: [(TimeseriesExecutor, [methods], {method: reduced} to fill)]
+        """
+        executors = [ts_executor for ts_executor, _, _ in members]
+        get_raster_executor = BatchExecutor._get_envelope_executor(executors, aggregation)
+        if get_raster_executor is None:
+            for ts_executor, methods, reduced in members:
+                reduced.update(
+                    ts_executor._get_raster_executor(aggregation).execute_reduced(
+                        ["latitude", "longitude"], methods, area_weighted=ts_executor.area_weighted
+                    )
+                )
+            return
+        raster = get_raster_executor.execute_lazy()
+        targets, partials = [], []
+        for ts_executor, methods, reduced in members:
+            selection = raster.sel(
+                valid_time=slice(ts_executor.start_datetime, ts_executor.end_datetime),
+                latitude=slice(ts_executor.max_lat, ts_executor.min_lat),
+                longitude=slice(ts_executor.min_lon, ts_executor.max_lon),
+            )
+            for method in methods:
+                targets.append((reduced, method))
+                partials.append(
+                    get_raster_executor._reduce(
+                        [selection], ["latitude", "longitude"], method, ts_executor.area_weighted
+                    )
+                )
+        # one graph over the shared chunks: every chunk of the envelope is read once for all members
+        with tracer.span("compute", members=len(members)):
+            partials = dask.compute(*partials)
+        for (reduced, method), partial in zip(targets, partials):
+            reduced[method] = partial
+
+    @staticmethod
+    def _get_envelope_executor(executors, aggregation):
+        """
+        Return: GetRasterExecutor over the envelope of executors, None when there is a single executor,
+            local files do not cover the envelope, or it holds over ENVELOPE_MAX_RATIO times the cells
+            of the union of the executors' boxes
+        """
+        if len(executors) == 1:
+            return None
+        first = executors[0]
+        start = min(pd.Timestamp(e.start_datetime) for e in executors)
+        end = max(pd.Timestamp(e.end_datetime) for e in executors)
+        bbox = (
+            min(e.min_lat for e in executors),
+            max(e.max_lat for e in executors),
+            min(e.min_lon for e in executors),
+            max(e.max_lon for e in executors),
+        )
+        _, leftover = first.metadata.query_get_overlap_and_leftover(
+            first.variable, start, end, *bbox, first.temporal_resolution, 0.25, aggregation
+        )
+        if leftover is not None:
+            return None
+
+        time_axis = TimeAxis(start, end, first.temporal_resolution)
+        boxes = []
+        for e in executors:
+            lat_start, lat_end, lon_start, lon_end = get_lat_lon_index_range(
+                0.25, e.min_lat, e.max_lat, e.min_lon, e.max_lon
+            )
+            boxes.append(
+                (time_axis.index_range(e.start_datetime, e.end_datetime), (lat_start, lat_end), (lon_start, lon_end))
+            )
+        union_size = 0
+        for i, box in enumerate(boxes):
+            pieces = [box]
+            for other in boxes[:i]:
+                pieces = [piece for p in pieces for piece in subtract_box(p, other)]
+            union_size += sum(_box_size(piece) for piece in pieces)
+        lat_start, lat_end, lon_start, lon_end = get_lat_lon_index_range(0.25, *bbox)
+        envelope_size = _box_size(((0, time_axis.size), (lat_start, lat_end), (lon_start, lon_end)))
+        if envelope_size > ENVELOPE_MAX_RATIO * union_size:
+            return None
+
+        min_lat, max_lat, min_lon, max_lon = bbox
+        return GetRasterExecutor(
+            variable=first.variable,
+            start_datetime=str(start),
+            end_datetime=str(end),
+            min_lat=min_lat,
+            max_lat=max_lat,
+            min_lon=min_lon,
+            max_lon=max_lon,
+            temporal_resolution=first.temporal_resolution,
+            spatial_resolution=0.25,
+            aggregation=aggregation,
+            metadata=first.metadata.f_path,
+        )
+
+
+def _box_size(box):
+    size = 1
+    for start, end in box:
+        size *= max(0, end - start)
+    return size
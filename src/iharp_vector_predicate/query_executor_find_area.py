@@ -1,5 +1,16 @@
+import numpy as np
+import xarray as xr
+
 from .query_executor import QueryExecutor
 from .query_executor_heatmap import HeatmapExecutor
+from .utils.const import get_lat_lon_index_range, get_lat_lon_range
+from .utils.planner import PRUNE_UNDECIDED_FRACTION
+from .utils.predicate import decide_from_bounds
+from .utils.stats_index import load_stats_index
+from .utils.tracing import tracer
+
+# coarse grids used to decide whole cells, coarsest first
+PYRAMID_SPATIAL_RESOLUTIONS = [1.0, 0.5]
 
 
 class FindAreaExecutor(QueryExecutor):
@@ -36,24 +47,58 @@ class FindAreaExecutor(QueryExecutor):
         self.filter_predicate = filter_predicate
         self.filter_value = filter_value
 
-    def execute(self):
-        return self._execute_baseline()
+    def _cache_params(self):
+        return (self.heatmap_aggregation_method, self.filter_predicate, float(self.filter_value))
+
+    def _candidate_plans(self):
+        """
+        baseline: the heatmap at spatial_resolution
+        pyramid: min / max heatmaps of every coarser grid, then the baseline; each step is expected to read
+            PRUNE_UNDECIDED_FRACTION of what the step before it would, the statistics sidecar being the first step
+        """
+        baseline_executor = self._get_baseline_executor(self.min_lat, self.max_lat, self.min_lon, self.max_lon)
+        baseline = baseline_executor._planned_reads()
+        plans = {"baseline": baseline}
+        stats_index = load_stats_index(self.metadata)
+        coarse_resolutions = [res for res in PYRAMID_SPATIAL_RESOLUTIONS if res > self.spatial_resolution]
+        if stats_index is None and not coarse_resolutions:
+            return plans
+        reads = []
+        fraction = 1 if stats_index is None else PRUNE_UNDECIDED_FRACTION
+        for coarse_res in coarse_resolutions:
+            for method in ("min", "max"):
+                heatmap_executor = self._get_heatmap_executor(
+                    coarse_res, method, self.min_lat, self.max_lat, self.min_lon, self.max_lon
+                )
+                reads.extend((e, fraction * f) for e, f in heatmap_executor._planned_reads())
+            fraction *= PRUNE_UNDECIDED_FRACTION
+        reads.extend((e, fraction * f) for e, f in baseline)
+        plans["pyramid"] = reads
+        return plans
 
-    def _execute_baseline(self):
-        heatmap_executor = HeatmapExecutor(
+    def _execute(self):
+        if self._choose_plan() == "pyramid":
+            return self._execute_pyramid()
+        return self._execute_baseline(self.min_lat, self.max_lat, self.min_lon, self.max_lon)
+
+    def _get_baseline_executor(self, min_lat, max_lat, min_lon, max_lon):
+        return self._nested_executor(
+            HeatmapExecutor,
             self.variable,
             self.start_datetime,
             self.end_datetime,
-            self.min_lat,
-            self.max_lat,
-            self.min_lon,
-            self.max_lon,
+            min_lat,
+            max_lat,
+            min_lon,
+            max_lon,
             self.spatial_resolution,
             self.aggregation,
             self.heatmap_aggregation_method,
             metadata=self.metadata.f_path,
         )
-        hm = heatmap_executor.execute()
+
+    def _execute_baseline(self, min_lat, max_lat, min_lon, max_lon):
+        hm = self._get_baseline_executor(min_lat, max_lat, min_lon, max_lon).execute()
         if self.filter_predicate == ">":
             res = hm.where(hm > self.filter_value, drop=False)
         elif self.filter_predicate == "<":
@@ -71,3 +116,128 @@ class FindAreaExecutor(QueryExecutor):
         res = res.fillna(False)
         res = res.astype(bool)
         return res
+
+    def _execute_pyramid(self):
+        """
+        Decide whole coarse cells (1.0, then 0.5) from min/max heatmaps of the same time range:
+        the heatmap value of every finer cell inside a coarse cell lies within the coarse min and max
+        (see utils.predicate.decide_from_bounds). Only cells left undecided are read at
+        spatial_resolution, one baseline heatmap per rectangle of undecided cells.
+        When the statistics sidecar exists (see utils.stats_index), its tile bounds decide cells first,
+        without reading rasters.
+        """
+        lat_range, lon_range, _ = get_lat_lon_range(self.spatial_resolution)
+        lat_start, lat_end, lon_start, lon_end = get_lat_lon_index_range(
+            self.spatial_resolution, self.min_lat, self.max_lat, self.min_lon, self.max_lon
+        )
+        lats = lat_range[lat_start:lat_end]
+        lons = lon_range[lon_start:lon_end]
+        # -1: undecided, 0: False, 1: True; latitude ascending
+        result = np.full((len(lats), len(lons)), -1, dtype=np.int8)
+
+        stats_index = load_stats_index(self.metadata)
+        if stats_index is not None and result.size > 0:
+            bounds = stats_index.cell_bounds(
+                self.variable, self.start_datetime, self.end_datetime, self.spatial_resolution, lats, lons
+            )
+            if bounds is not None:
+                with tracer.span("prune_decision", level="stats") as span:
+                    result = decide_from_bounds(self.filter_predicate, self.filter_value, *bounds)
+                    span.set(cells_decided=int((result != -1).sum()))
+
+        for coarse_res in PYRAMID_SPATIAL_RESOLUTIONS:
+            undecided = result == -1
+            if coarse_res <= self.spatial_resolution or not undecided.any():
+                continue
+            rows = np.flatnonzero(undecided.any(axis=1))
+            cols = np.flatnonzero(undecided.any(axis=0))
+            bbox = (lats[rows[0]], lats[rows[-1]], lons[cols[0]], lons[cols[-1]])
+            coarse_lat_start, coarse_lat_end, coarse_lon_start, coarse_lon_end = get_lat_lon_index_range(
+                coarse_res, *bbox
+            )
+            if coarse_lat_start >= coarse_lat_end or coarse_lon_start >= coarse_lon_end:
+                continue
+            hm_min = self._get_heatmap_executor(coarse_res, "min", *bbox).execute()
+            hm_max = self._get_heatmap_executor(coarse_res, "max", *bbox).execute()
+            lat_idx, lat_inside = self._coarse_cell_index(lats, coarse_res, get_lat_lon_range(coarse_res)[0])
+            lon_idx, lon_inside = self._coarse_cell_index(lons, coarse_res, get_lat_lon_range(coarse_res)[1])
+            with tracer.span("prune_decision", level=coarse_res) as span:
+                mins = self._values_on_coarse_grid(hm_min, coarse_res)[np.ix_(lat_idx, lon_idx)]
+                maxs = self._values_on_coarse_grid(hm_max, coarse_res)[np.ix_(lat_idx, lon_idx)]
+                decision = decide_from_bounds(self.filter_predicate, self.filter_value, mins, maxs)
+                decision[~np.outer(lat_inside, lon_inside)] = -1
+                result[undecided] = decision[undecided]
+                span.set(cells_decided=int((decision[undecided] != -1).sum()))
+
+        for row_start, row_end, col_start, col_end in self._undecided_rectangles(result == -1):
+            rest = self._execute_baseline(lats[row_start], lats[row_end - 1], lons[col_start], lons[col_end - 1])
+            rest = rest[self.variable_short_name].reindex(
+                latitude=lats[row_start:row_end],
+                longitude=lons[col_start:col_end],
+                method="nearest",
+                tolerance=self.spatial_resolution / 4,
+                fill_value=False,
+            )
+            result[row_start:row_end, col_start:col_end] = rest.values.astype(np.int8)
+
+        return xr.Dataset(
+            data_vars={self.variable_short_name: (["latitude", "longitude"], result[::-1].astype(bool))},
+            coords={"latitude": lats[::-1], "longitude": lons},
+        )
+
+    def _get_heatmap_executor(self, spatial_resolution, method, min_lat, max_lat, min_lon, max_lon):
+        return self._nested_executor(
+            HeatmapExecutor,
+            self.variable,
+            self.start_datetime,
+            self.end_datetime,
+            min_lat,
+            max_lat,
+            min_lon,
+            max_lon,
+            spatial_resolution,
+            method,
+            method,
+            metadata=self.metadata.f_path,
+        )
+
+    @staticmethod
+    def _coarse_cell_index(values, coarse_res, coarse_range):
+        """
+        Return: (index into coarse_range of the cell holding each value, whether the value is inside it)
+        Coarse cells are centered on their coordinate (see utils.const), edges of the fine grid may be trimmed
+        """
+        idx = np.clip(np.rint((values - coarse_range[0]) / coarse_res).astype(int), 0, len(coarse_range) - 1)
+        return idx, np.abs(values - coarse_range[idx]) < coarse_res / 2
+
+    def _values_on_coarse_grid(self, hm, coarse_res):
+        """
+        Return: heatmap values scattered on the full (ascending) coarse grid, NaN where missing
+        """
+        lat_range, lon_range, _ = get_lat_lon_range(coarse_res)
+        lat_idx, _ = self._coarse_cell_index(hm["latitude"].values, coarse_res, lat_range)
+        lon_idx, _ = self._coarse_cell_index(hm["longitude"].values, coarse_res, lon_range)
+        values = np.full((len(lat_range), len(lon_range)), np.nan)
+        values[np.ix_(lat_idx, lon_idx)] = hm[self.variable_short_name].transpose("latitude", "longitude").values
+        return values
+
+    @staticmethod
+    def _undecided_rectangles(undecided):
+        """
+        Return: [(row_start, row_end, col_start, col_end)], half-open rectangles covering the undecided
+        cells, built from runs of undecided cells per row and merged across rows with the same run
+        """
+        rectangles = []
+        open_runs = {}
+        for row in range(undecided.shape[0] + 1):
+            runs = set()
+            if row < undecided.shape[0]:
+                padded = np.concatenate(([False], undecided[row], [False])).astype(np.int8)
+                edges = np.flatnonzero(np.diff(padded))
+                runs = set(zip(edges[::2], edges[1::2]))
+            for run in list(open_runs):
+                if run not in runs:
+                    rectangles.append((open_runs.pop(run), row, run[0], run[1]))
+            for run in runs:
+                open_runs.setdefault(run, row)
+        return rectangles
@@ -1,9 +1,18 @@
+import numpy as np
 import pandas as pd
 import xarray as xr
 
+from .metadata import subtract_box
 from .query_executor import QueryExecutor
 from .query_executor_timeseries import TimeseriesExecutor
-from .utils.get_whole_period import get_whole_period_between, get_last_date_of_month, time_array_to_range
+from .utils.const import time_resolution_to_freq
+from .utils.planner import PRUNE_UNDECIDED_FRACTION
+from .utils.predicate import decide_from_bounds
+from .utils.stats_index import load_stats_index
+from .utils.tracing import tracer
+
+# numpy datetime64 unit of each temporal resolution, coarsest first
+PERIOD_UNITS = {"year": "Y", "month": "M", "day": "D", "hour": "h"}
 
 
 class FindTimeExecutor(QueryExecutor):
@@ -40,13 +49,62 @@ class FindTimeExecutor(QueryExecutor):
         self.filter_predicate = filter_predicate
         self.filter_value = filter_value
 
-    def execute(self):
-        if self.temporal_resolution == "hour" and self.filter_predicate != "!=":
-            return self._execute_pyramid_hour()
+    def _cache_params(self):
+        return (self.time_series_aggregation_method, self.filter_predicate, float(self.filter_value))
+
+    def _candidate_plans(self):
+        """
+        baseline: the time series at temporal_resolution
+        pyramid: min / max series of every coarser level over its whole periods, then the baseline;
+            each step is expected to read PRUNE_UNDECIDED_FRACTION of what the step before it would,
+            levels held by the statistics sidecar read no raster
+        """
+        baseline = self._get_timeseries_executor(self.start_datetime, self.end_datetime)._planned_reads()
+        plans = {"baseline": baseline}
+        if self.temporal_resolution not in PERIOD_UNITS or self.temporal_resolution == "year":
+            return plans
+        target_unit = PERIOD_UNITS[self.temporal_resolution]
+        points = self._time_points().values.astype(f"datetime64[{target_unit}]")
+        if len(points) == 0:
+            return plans
+        stats_index = load_stats_index(self.metadata)
+        reads = []
+        fraction = 1
+        for temporal_res, unit in PERIOD_UNITS.items():
+            if temporal_res == self.temporal_resolution:
+                break
+            periods, _, _ = self._whole_periods(points, points[0], points[-1], unit, target_unit)
+            if len(periods) == 0:
+                continue
+            ranges = self._min_max_ranges(periods, temporal_res, unit)
+            if not ranges:
+                continue
+            if stats_index is None or (
+                stats_index.period_bounds(
+                    self.variable, temporal_res, self.min_lat, self.max_lat, self.min_lon, self.max_lon
+                )
+                is None
+            ):
+                for start, end in ranges:
+                    min_max_exec = self._get_min_max_executor(start, end, temporal_res)
+                    reads.extend((e, fraction * f) for e, f in min_max_exec._planned_reads())
+            fraction *= PRUNE_UNDECIDED_FRACTION
+        reads.extend((e, fraction * f) for e, f in baseline)
+        plans["pyramid"] = reads
+        return plans
+
+    def _execute(self):
+        if self._choose_plan() == "pyramid":
+            return self._execute_pyramid()
         return self._execute_baseline(self.start_datetime, self.end_datetime)
 
     def _execute_baseline(self, start_datetime, end_datetime):
-        timeseries_executor = TimeseriesExecutor(
+        ts = self._get_timeseries_executor(start_datetime, end_datetime).execute()
+        return self._apply_predicate(ts)
+
+    def _get_timeseries_executor(self, start_datetime, end_datetime):
+        return self._nested_executor(
+            TimeseriesExecutor,
             variable=self.variable,
             start_datetime=start_datetime,
             end_datetime=end_datetime,
@@ -59,7 +117,8 @@ class FindTimeExecutor(QueryExecutor):
             time_series_aggregation_method=self.time_series_aggregation_method,
             metadata=self.metadata.f_path,
         )
-        ts = timeseries_executor.execute()
+
+    def _apply_predicate(self, ts):
         if self.filter_predicate == ">":
             res = ts.where(ts > self.filter_value, drop=False)
         elif self.filter_predicate == "<":
@@ -78,174 +137,189 @@ class FindTimeExecutor(QueryExecutor):
         res = res.astype(bool)
         return res
 
-    def _execute_pyramid_hour(self):
+    def _execute_pyramid(self):
         """
-        Optimizations heuristics:
-            - find hour >  x: if year-min >  x, return True ; if year-max <= x, return False
-            - find hour <  x: if year-min >= x, return False; if year-max <  x, return True
-            - find hour == x: if year-min >  x, return False; if year-max <  x, return False
-            - find hour >= x: if year-min >= x, return True ; if year-max <  x, return False
-            - find hour <= x: if year-min >  x, return False; if year-max <= x, return True
+        Optimizations heuristics, for every level coarser than temporal_resolution:
+            - find >  x: if level-min >  x, return True ; if level-max <= x, return False
+            - find <  x: if level-min >= x, return False; if level-max <  x, return True
+            - find == x: if level-min >  x, return False; if level-max <  x, return False
+            - find >= x: if level-min >= x, return True ; if level-max <  x, return False
+            - find <= x: if level-min >  x, return False; if level-max <= x, return True
+            - find != x: if level-min >  x or level-max < x, return True; if level-min == level-max == x, return False
+        (see utils.predicate.decide_from_bounds). Any aggregate of values lies within their min and max,
+        so a coarser period decides all the time points inside it. Each level (year, month, day) is decided
+        for all its whole periods at once; periods left undecided are handed to the next finer level,
+        and the remaining time points to the baseline.
+        Level bounds come from the statistics sidecar when it holds the bbox (see utils.stats_index),
+        otherwise from the pre-aggregated rasters; periods whose rasters are missing from the metadata
+        are left to the finer levels.
         """
-        years, months, days, hours = get_whole_period_between(self.start_datetime, self.end_datetime)
-        time_points = pd.date_range(start=self.start_datetime, end=self.end_datetime, freq="h")
-        result = xr.Dataset(
-            data_vars={self.variable_short_name: (["valid_time"], [None] * len(time_points))},
+        target_unit = PERIOD_UNITS[self.temporal_resolution]
+        time_points = self._time_points()
+        points = time_points.values.astype(f"datetime64[{target_unit}]")
+        if len(points) == 0:
+            return self._execute_baseline(self.start_datetime, self.end_datetime)
+        # -1: undecided, 0: False, 1: True
+        result = np.full(len(points), -1, dtype=np.int8)
+
+        for temporal_res, unit in PERIOD_UNITS.items():
+            if temporal_res == self.temporal_resolution:
+                break
+            periods, period_start, period_end = self._whole_periods(
+                points[result == -1], points[0], points[-1], unit, target_unit
+            )
+            if len(periods) == 0:
+                continue
+
+            ranges = self._min_max_ranges(periods, temporal_res, unit)
+            if not ranges:
+                continue
+            ts_min, ts_max = self._get_min_max_time_series(ranges, temporal_res)
+            with tracer.span("prune_decision", level=temporal_res, periods=len(periods)) as span:
+                decision = decide_from_bounds(
+                    self.filter_predicate,
+                    self.filter_value,
+                    self._values_for_periods(ts_min, periods, unit),
+                    self._values_for_periods(ts_max, periods, unit),
+                )
+                decided = decision != -1
+                offsets = (period_start[decided] - points[0]).astype(np.int64)
+                lengths = (period_end[decided] - period_start[decided]).astype(np.int64) + 1
+                run_starts = np.cumsum(lengths) - lengths
+                index = np.repeat(offsets - run_starts, lengths) + np.arange(lengths.sum())
+                result[index] = np.repeat(decision[decided], lengths)
+                span.set(periods_decided=int(decided.sum()), cells_decided=int(lengths.sum()))
+
+        undecided = np.flatnonzero(result == -1)
+        if undecided.size > 0:
+            first, last = undecided[0], undecided[-1]
+            start = max(self._period_first_hour(points[first]), pd.Timestamp(self.start_datetime))
+            end = min(self._period_last_hour(points[last]), pd.Timestamp(self.end_datetime))
+            rest = self._execute_baseline(
+                start_datetime=start.strftime("%Y-%m-%d %H:%M:%S"),
+                end_datetime=end.strftime("%Y-%m-%d %H:%M:%S"),
+            )
+            rest_values = rest[self.variable_short_name].reindex(valid_time=time_points[first : last + 1])
+            span = result[first : last + 1]
+            span[span == -1] = rest_values.fillna(False).values.astype(np.int8)[span == -1]
+
+        return xr.Dataset(
+            data_vars={self.variable_short_name: (["valid_time"], result.astype(bool))},
             coords=dict(valid_time=time_points),
         )
 
-        if years:
-            print("checking years")
-            year_range = time_array_to_range(years, "year")
-            year_min, year_max = self._get_min_max_time_series(year_range, "year")
-            for year in years:
-                year_determined = False
-                year_datetime = f"{year}-12-31 00:00:00"
-                curr_year_min = year_min[self.variable_short_name].sel(valid_time=year_datetime).values.item()
-                curr_year_max = year_max[self.variable_short_name].sel(valid_time=year_datetime).values.item()
-                print(f"year: {year}, min: {curr_year_min}, max: {curr_year_max}")
-                if self.filter_predicate == ">":
-                    if curr_year_min > self.filter_value:
-                        print(f"{year}: min > filter, True")
-                        year_determined = True
-                        result[self.variable_short_name].loc[str(year) : str(year)] = True
-                    elif curr_year_max <= self.filter_value:
-                        print(f"{year}: max <= filter, False")
-                        year_determined = True
-                        result[self.variable_short_name].loc[str(year) : str(year)] = False
-                elif self.filter_predicate == "<":
-                    if curr_year_min >= self.filter_value:
-                        print(f"{year}: min >= filter, False")
-                        year_determined = True
-                        result[self.variable_short_name].loc[str(year) : str(year)] = False
-                    elif curr_year_max < self.filter_value:
-                        print(f"{year}: max < filter, True")
-                        year_determined = True
-                        result[self.variable_short_name].loc[str(year) : str(year)] = True
-                elif self.filter_predicate == "==":
-                    if curr_year_min > self.filter_value or curr_year_max < self.filter_value:
-                        print(f"{year}: min > filter or max < filter, False")
-                        year_determined = True
-                        result[self.variable_short_name].loc[str(year) : str(year)] = False
-                if not year_determined:
-                    # add months to months
-                    months = months + [f"{year}-{month:02d}" for month in range(1, 13)]
-
-        if months:
-            print("checking months")
-            month_range = time_array_to_range(months, "month")
-            month_min, month_max = self._get_min_max_time_series(month_range, "month")
-            for month in months:
-                month_determined = False
-                month_datetime = f"{month}-{get_last_date_of_month(pd.Timestamp(month))} 00:00:00"
-                curr_month_min = month_min[self.variable_short_name].sel(valid_time=month_datetime).values.item()
-                curr_month_max = month_max[self.variable_short_name].sel(valid_time=month_datetime).values.item()
-                if self.filter_predicate == ">":
-                    if curr_month_min > self.filter_value:
-                        print(f"{month}: min > filter, True")
-                        month_determined = True
-                        result[self.variable_short_name].loc[month:month] = True
-                    elif curr_month_max <= self.filter_value:
-                        print(f"{month}: max <= filter, False")
-                        month_determined = True
-                        result[self.variable_short_name].loc[month:month] = False
-                elif self.filter_predicate == "<":
-                    if curr_month_min >= self.filter_value:
-                        print(f"{month}: min >= filter, False")
-                        month_determined = True
-                        result[self.variable_short_name].loc[month:month] = False
-                    elif curr_month_max < self.filter_value:
-                        print(f"{month}: max < filter, True")
-                        month_determined = True
-                        result[self.variable_short_name].loc[month:month] = True
-                elif self.filter_predicate == "==":
-                    if curr_month_min > self.filter_value or curr_month_max < self.filter_value:
-                        print(f"{month}: min > filter or max < filter, False")
-                        month_determined = True
-                        result[self.variable_short_name].loc[month:month] = False
-                if not month_determined:
-                    # add days to days
-                    days = days + [
-                        f"{month}-{day:02d}" for day in range(1, get_last_date_of_month(pd.Timestamp(month)) + 1)
-                    ]
-
-        if days:
-            print("checking days")
-            day_range = time_array_to_range(days, "day")
-            day_min, day_max = self._get_min_max_time_series(day_range, "day")
-            for day in days:
-                day_determined = False
-                day_datetime = f"{day} 00:00:00"
-                curr_day_min = day_min[self.variable_short_name].sel(valid_time=day_datetime).values.item()
-                curr_day_max = day_max[self.variable_short_name].sel(valid_time=day_datetime).values.item()
-                if self.filter_predicate == ">":
-                    if curr_day_min > self.filter_value:
-                        print(f"{day}: min > filter, True")
-                        day_determined = True
-                        result[self.variable_short_name].loc[day:day] = True
-                    elif curr_day_max <= self.filter_value:
-                        print(f"{day}: max <= filter, False")
-                        day_determined = True
-                        result[self.variable_short_name].loc[day:day] = False
-                elif self.filter_predicate == "<":
-                    if curr_day_min >= self.filter_value:
-                        print(f"{day}: min >= filter, False")
-                        day_determined = True
-                        result[self.variable_short_name].loc[day:day] = False
-                    elif curr_day_max < self.filter_value:
-                        print(f"{day}: max < filter, True")
-                        day_determined = True
-                        result[self.variable_short_name].loc[day:day] = True
-                elif self.filter_predicate == "==":
-                    if curr_day_min > self.filter_value or curr_day_max < self.filter_value:
-                        print(f"{day}: min > filter or max < filter, False")
-                        day_determined = True
-                        result[self.variable_short_name].loc[day:day] = False
-                if not day_determined:
-                    # add hours to hours
-                    hours = hours + [f"{day} {hour:02d}:00:00" for hour in range(24)]
-
-        result_undetermined = result["valid_time"].where(result[self.variable_short_name].isnull(), drop=True)
-        if result_undetermined.size > 0:
-            hour_range = time_array_to_range(result_undetermined.values, "hour")
-            first_hour = hour_range[0][0]
-            last_hour = hour_range[-1][1]
-            start = first_hour.strftime("%Y-%m-%d %H:%M:%S")
-            end = last_hour.strftime("%Y-%m-%d %H:%M:%S")
-            rest = self._execute_baseline(start_datetime=start, end_datetime=end)
-            result[self.variable_short_name].loc[f"{start}":f"{end}"] = rest[self.variable_short_name]
-        result[self.variable_short_name] = result[self.variable_short_name].astype(bool)
-        return result
+    def _time_points(self):
+        return pd.date_range(
+            start=self.start_datetime,
+            end=self.end_datetime,
+            freq=time_resolution_to_freq(self.temporal_resolution),
+        )
+
+    @staticmethod
+    def _whole_periods(points, first, last, unit, target_unit):
+        """
+        Return: (periods as datetime64[unit], their first and last point as datetime64[target_unit])
+            of the periods holding points that lie wholly between first and last
+        """
+        periods = np.unique(points.astype(f"datetime64[{unit}]"))
+        period_start = periods.astype(f"datetime64[{target_unit}]")
+        period_end = (periods + 1).astype(f"datetime64[{target_unit}]") - 1
+        whole = (period_start >= first) & (period_end <= last)
+        return periods[whole], period_start[whole], period_end[whole]
+
+    @staticmethod
+    def _period_first_hour(period):
+        return pd.Timestamp(period.astype("datetime64[h]"))
+
+    @staticmethod
+    def _period_last_hour(period):
+        return pd.Timestamp((period + 1).astype("datetime64[h]") - 1)
+
+    def _values_for_periods(self, ts, periods, unit):
+        """
+        Return: values of ts at each period (datetime64[unit]), NaN where ts has no label in the period
+        """
+        ts_periods = ts["valid_time"].values.astype(f"datetime64[{unit}]")
+        ts_values = ts[self.variable_short_name].values.astype(np.float64)
+        pos = np.minimum(ts_periods.searchsorted(periods), len(ts_periods) - 1)
+        return np.where(ts_periods[pos] == periods, ts_values[pos], np.nan)
+
+    def _min_max_ranges(self, periods, temporal_res, unit):
+        """
+        Return: [[first hour, last hour]] to read the min / max series of periods (datetime64[unit]) from:
+            the whole span when the statistics sidecar holds the bbox, otherwise the runs of periods
+            within the span whose min and max rasters are in the metadata, if they hold any of periods
+        """
+        first, last = self._period_first_hour(periods[0]), self._period_last_hour(periods[-1])
+        stats_index = load_stats_index(self.metadata)
+        if stats_index is not None:
+            bounds = stats_index.period_bounds(
+                self.variable, temporal_res, self.min_lat, self.max_lat, self.min_lon, self.max_lon
+            )
+            if bounds is not None:
+                return [[first, last]]
+        runs = [((periods[0], periods[-1] + 1),)]
+        for aggregation in ("min", "max"):
+            _, leftover = self.metadata.query_get_overlap_and_leftover(
+                self.variable,
+                first,
+                last,
+                self.min_lat,
+                self.max_lat,
+                self.min_lon,
+                self.max_lon,
+                temporal_res,
+                self.spatial_resolution,
+                aggregation,
+            )
+            for box in leftover or []:
+                missing = tuple(
+                    pd.Timestamp(box[key]).to_datetime64().astype(f"datetime64[{unit}]")
+                    for key in ("start_datetime", "end_datetime")
+                )
+                runs = [piece for run in runs for piece in subtract_box(run, ((missing[0], missing[1] + 1),))]
+        return [
+            [self._period_first_hour(run_start), self._period_last_hour(run_end - 1)]
+            for ((run_start, run_end),) in sorted(runs)
+            if ((periods >= run_start) & (periods < run_end)).any()
+        ]
 
     def _get_min_max_time_series(self, _range, temporal_res):
-        total_start = _range[0][0]
-        total_end = _range[-1][1]
-        min_exec = TimeseriesExecutor(
-            variable=self.variable,
-            start_datetime=total_start,
-            end_datetime=total_end,
-            min_lat=self.min_lat,
-            max_lat=self.max_lat,
-            min_lon=self.min_lon,
-            max_lon=self.max_lon,
-            temporal_resolution=temporal_res,
-            aggregation="min",
-            time_series_aggregation_method="min",
-            metadata=self.metadata.f_path,
+        stats_index = load_stats_index(self.metadata)
+        if stats_index is not None:
+            bounds = stats_index.period_bounds(
+                self.variable, temporal_res, self.min_lat, self.max_lat, self.min_lon, self.max_lon
+            )
+            if bounds is not None:
+                periods, mins, maxs = bounds
+                return tuple(
+                    xr.Dataset({self.variable_short_name: (["valid_time"], values)}, coords={"valid_time": periods})
+                    for values in (mins, maxs)
+                )
+        min_max_ts = xr.concat(
+            [self._get_min_max_executor(start, end, temporal_res).execute() for start, end in _range],
+            dim="valid_time",
+        )
+        min_ts = min_max_ts[[f"{self.variable_short_name}_min"]].rename(
+            {f"{self.variable_short_name}_min": self.variable_short_name}
+        )
+        max_ts = min_max_ts[[f"{self.variable_short_name}_max"]].rename(
+            {f"{self.variable_short_name}_max": self.variable_short_name}
         )
-        max_exec = TimeseriesExecutor(
+        return min_ts, max_ts
+
+    def _get_min_max_executor(self, start_datetime, end_datetime, temporal_res):
+        return self._nested_executor(
+            TimeseriesExecutor,
             variable=self.variable,
-            start_datetime=total_start,
-            end_datetime=total_end,
+            start_datetime=start_datetime,
+            end_datetime=end_datetime,
             min_lat=self.min_lat,
             max_lat=self.max_lat,
             min_lon=self.min_lon,
             max_lon=self.max_lon,
             temporal_resolution=temporal_res,
-            aggregation="max",
-            time_series_aggregation_method="max",
+            aggregation="min",
+            time_series_aggregation_method=["min", "max"],
             metadata=self.metadata.f_path,
         )
-        min_ts = min_exec.execute()
-        max_ts = max_exec.execute()
-        return min_ts, max_ts
@@ -1,14 +1,14 @@
-from datetime import datetime
-import pandas as pd
+import os
+import dask
 import xarray as xr
 import geopandas as gpd
 import numpy as np
-from shapely.vectorized import contains
-import matplotlib.pyplot as plt
-from matplotlib.patches import Polygon as PlotPolygon
+import shapely
 
 from .query_executor import QueryExecutor
-from .utils.const import time_resolution_to_freq
+from .utils.const import get_lat_lon_index_range, get_lat_lon_range, get_lat_weights
+from .utils.rasterize import mask_cache, plan_reads
+from .utils.tracing import tracer
 from .query_executor_get_raster import GetRasterExecutor
 
 class GeoJsonExecutor(QueryExecutor):
@@ -25,6 +25,11 @@ class GeoJsonExecutor(QueryExecutor):
         max_lat: float = None,
         min_lon: float = None,
         max_lon: float = None,
+        metadata=None,  # metadata file path
+        per_feature: bool = False,  # mask every feature, with a feature dimension
+        zonal_method: str = None,  # e.g., "mean", "max", "min": per-feature time series instead of rasters
+        debug: bool = False,  # record mask point counts on the trace and plot the mask to data_plot.png
+        fractional: bool = False,  # weight edge cells by the fraction of their area inside the polygon
     ):
         super().__init__(
             variable,
@@ -37,129 +42,244 @@ class GeoJsonExecutor(QueryExecutor):
             temporal_resolution,
             spatial_resolution,
             aggregation,
+            metadata=metadata,
         )
         self.geojson_file = geojson_file
+        self.per_feature = per_feature
+        self.zonal_method = zonal_method
+        self.debug = debug
+        self.fractional = fractional
 
     def _load_geojson(self):
         with open(self.geojson_file, 'r') as file:
             gdf = gpd.read_file(file)
         return gdf
 
-    def _extract_coordinates(self, geojson_data):
-        coords = []
-        coords.extend(geojson_data["coordinates"])
-        return coords
-    
-    def _create_boudning_box(self, coordinates):
-        longs = []
-        lats = []
-        for coord in coordinates:
-            longs.append(coord[0])
-            lats.append(coord[1])
-        return min(longs), min(lats), max(longs), max(lats)
-    
+    def _load_features(self):
+        """
+        Return: [shapely (Multi)Polygon], one per feature, closed LineStrings are read as Polygons
+        """
+        features = []
+        for i, geom in enumerate(self._load_geojson().geometry):
+            if geom is not None and geom.geom_type in ("LineString", "LinearRing") and geom.is_closed:
+                geom = shapely.Polygon(geom.coords)
+            if geom is None or geom.geom_type not in ("Polygon", "MultiPolygon"):
+                geom_type = None if geom is None else geom.geom_type
+                raise ValueError(
+                    f"Unsupported geometry of feature {i} in {self.geojson_file}: {geom_type}, "
+                    "expected a Polygon, MultiPolygon or closed LineString"
+                )
+            features.append(geom)
+        return features
+
     def _mask_raster_data(self, raster, polygon):
         lons = raster["longitude"].values
         lats = raster["latitude"].values
-        mesh_lons, mesh_lats = np.meshgrid(lons, lats) # maybe add indexing='ij'
-        points = np.vstack((mesh_lons.ravel(), mesh_lats.ravel())).T
-
-        # mask = []
-        # for lon, lat in points:
-        #     point = shapely.geometry.Point(lon, lat)
-        #     in_polygon = polygon.contains(point)
-        #     mask.append(in_polygon)
-
-        mask = contains(polygon, points[:, 0], points[:, 1])
-        
-        mask = np.array(mask)
-        
-        mask = mask.reshape(mesh_lons.shape)
+        mask = mask_cache.get(polygon, lats, lons, self.spatial_resolution, fractional=self.fractional)
         mask_da = xr.DataArray(mask, dims=["latitude", "longitude"], coords={"latitude": lats, "longitude": lons})
 
-        masked_data = raster.where(mask_da, drop=False)
-        # print(f'raster count: {raster.count()}')
-        # print(raster.isel(valid_time=slice(0, 5)))
-        # print(f'masked Data: {masked_data.count()}')
-        # # original_valid = np.sum(~np.isnan(raster.t2m.values))
-        # # masked_valid = np.sum(~np.isnan(masked_data.t2m.values))
-        # # print(f"Original valid points: {original_valid}")
-        # # print(f"Masked valid points: {masked_valid}")
-        # #raster["t2m"] = raster["t2m"].where(mask, other=np.nan)
+        masked_data = raster.where(mask_da > 0, drop=False)
+        if self.fractional:
+            masked_data["coverage"] = mask_da
+        return masked_data
+
+    def _feature_masks(self, raster, features):
+        """
+        Return: array (feature, latitude, longitude), bool grid points inside each feature,
+            or the fraction of each cell inside it if fractional; masks are cached per geometry
+        """
+        lons = raster["longitude"].values
+        lats = raster["latitude"].values
+        return np.stack(
+            [mask_cache.get(f, lats, lons, self.spatial_resolution, fractional=self.fractional) for f in features]
+        )
+
+    def _bounds(self, features):
+        """
+        Return: (min_lon, min_lat, max_lon, max_lat) of the features,
+            padded by half a cell if fractional, so that cells partly inside are read too
+        """
+        bounds = shapely.bounds(np.asarray(features, dtype=object))
+        pad = self.spatial_resolution / 2 if self.fractional else 0
+        return (
+            bounds[:, 0].min() - pad,
+            bounds[:, 1].min() - pad,
+            bounds[:, 2].max() + pad,
+            bounds[:, 3].max() + pad,
+        )
+
+    def _zonal_reduce(self, raster, masks):
+        """
+        Return: xarray.Dataset (feature, valid_time) of zonal_method over each feature's grid points
+            "mean" weights cells by their area inside the feature: mask (coverage if fractional) * cos(latitude)
+        """
+        lat_weights = get_lat_weights(self.spatial_resolution, raster["latitude"].values).values
+        weights = (masks * lat_weights[:, None]).reshape(len(masks), -1)
+        flat_masks = masks.reshape(len(masks), -1) > 0
+        data_vars = {}
+        for name, da in raster.data_vars.items():
+            values = da.transpose("valid_time", "latitude", "longitude").values
+            values = values.reshape(len(values), -1)
+            if self.zonal_method == "mean":
+                valid = ~np.isnan(values)
+                sums = np.where(valid, values, 0) @ weights.T
+                counts = valid.astype(np.float64) @ weights.T
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    reduced = sums / counts
+            elif self.zonal_method in ("max", "min"):
+                reduce = np.fmax if self.zonal_method == "max" else np.fmin
+                reduced = np.full((len(values), len(flat_masks)), np.nan)
+                for i, mask in enumerate(flat_masks):
+                    if mask.any():
+                        reduced[:, i] = reduce.reduce(values[:, mask], axis=1)
+            else:
+                raise ValueError(f"Invalid zonal_method: {self.zonal_method}")
+            data_vars[name] = (["feature", "valid_time"], reduced.T)
+        return xr.Dataset(
+            data_vars=data_vars,
+            coords={"feature": np.arange(len(flat_masks)), "valid_time": raster["valid_time"].values},
+        )
+
+    def _candidate_plans(self):
+        # upper bound: the bbox of all features, only the rectangles they touch are read (see _read_raster)
+        min_lon, min_lat, max_lon, max_lat = self._bounds(self._load_features())
+        return {"default": [(self._get_raster_executor(min_lat, max_lat, min_lon, max_lon), 1)]}
+
+    def _get_raster_executor(self, min_lat, max_lat, min_lon, max_lon):
+        return GetRasterExecutor(
+            variable=self.variable,
+            start_datetime=self.start_datetime,
+            end_datetime=self.end_datetime,
+            min_lat=min_lat,
+            max_lat=max_lat,
+            min_lon=min_lon,
+            max_lon=max_lon,
+            temporal_resolution=self.temporal_resolution,
+            spatial_resolution=self.spatial_resolution,
+            aggregation=self.aggregation,
+            metadata=self.metadata.f_path,
+        )
+
+    def _read_raster(self, features):
+        """
+        Return: raster over the features' bounds on the spatial_resolution grid, read only on the
+            grid-aligned rectangles planned over the cells the features touch (see utils.rasterize.plan_reads);
+            cells outside those rectangles are NaN
+        """
+        min_lon, min_lat, max_lon, max_lat = self._bounds(features)
+        lat_range, lon_range, _ = get_lat_lon_range(self.spatial_resolution)
+        lat_start, lat_end, lon_start, lon_end = get_lat_lon_index_range(
+            self.spatial_resolution, min_lat, max_lat, min_lon, max_lon
+        )
+        # latitude descending, as in the files
+        lats = lat_range[lat_start:lat_end][::-1]
+        lons = lon_range[lon_start:lon_end]
+        with tracer.span("prune_decision", source="mask") as span:
+            needed = np.zeros((len(lats), len(lons)), dtype=bool)
+            for f in features:
+                needed |= mask_cache.get(f, lats, lons, self.spatial_resolution, fractional=self.fractional) > 0
+            rectangles = plan_reads(needed)
+            span.set(cells_decided=int((~needed).sum()), rectangles=len(rectangles))
+        if not rectangles:
+            return self._get_raster_executor(min_lat, max_lat, min_lon, max_lon).execute()
+        pieces = []
+        for row_start, row_end, col_start, col_end in rectangles:
+            get_raster_executor = self._get_raster_executor(
+                lats[row_end - 1], lats[row_start], lons[col_start], lons[col_end - 1]
+            )
+            pieces.append(get_raster_executor.execute_lazy())
+        # pieces are loaded before they are aligned, alignment is cheaper on numpy than on dask chunks
+        with tracer.span("compute"):
+            pieces = dask.compute(*pieces)
+        return GetRasterExecutor._merge(pieces).reindex(
+            latitude=lats, longitude=lons, method="nearest", tolerance=self.spatial_resolution / 4
+        )
+
+    def _execute_features(self):
+        features = self._load_features()
+        raster = self._read_raster(features)
+        with tracer.span("mask", features=len(features)):
+            masks = self._feature_masks(raster, features)
+        if self.zonal_method is not None:
+            return self._zonal_reduce(raster, masks)
+        mask_da = xr.DataArray(
+            masks,
+            dims=["feature", "latitude", "longitude"],
+            coords={
+                "feature": np.arange(len(features)),
+                "latitude": raster["latitude"].values,
+                "longitude": raster["longitude"].values,
+            },
+        )
+        masked_data = raster.where(mask_da > 0, drop=False).transpose("feature", ...)
+        if self.fractional:
+            masked_data["coverage"] = mask_da
         return masked_data
-    
+
     def _visualize_mask(self, raster, masked_raster, polygon):
+        import matplotlib.pyplot as plt
 
+        var = self.variable_short_name
         fig, axs = plt.subplots(1, 3, figsize=(18, 6))
 
-        plt1 = axs[0].pcolormesh(raster.longitude, raster.latitude, raster.t2m.isel(valid_time=0))
+        plt1 = axs[0].pcolormesh(raster.longitude, raster.latitude, raster[var].isel(valid_time=0))
         axs[0].set_title("Original Raster Data")
         fig.colorbar(plt1, ax=axs[0])
 
-        masked_raster = self._mask_raster_data(raster, polygon)
-        plt2 = axs[1].pcolormesh(masked_raster.longitude, masked_raster.latitude, masked_raster.t2m.isel(valid_time=0), cmap="binary") 
+        plt2 = axs[1].pcolormesh(
+            masked_raster.longitude, masked_raster.latitude, masked_raster[var].isel(valid_time=0), cmap="binary"
+        )
         axs[1].set_title("Mask")
         fig.colorbar(plt2, ax=axs[1])
 
-        plt3 = axs[2].pcolormesh(masked_raster.longitude, masked_raster.latitude, masked_raster.t2m.isel(valid_time=0))
+        plt3 = axs[2].pcolormesh(masked_raster.longitude, masked_raster.latitude, masked_raster[var].isel(valid_time=0))
         axs[2].set_title("Masked Data")
         fig.colorbar(plt3, ax=axs[2])
 
         for ax in axs:
-            x, y = polygon.exterior.xy
-            ax.plot(x, y, color="red")
+            for part in getattr(polygon, "geoms", [polygon]):
+                x, y = part.exterior.xy
+                ax.plot(x, y, color="red")
         plt.tight_layout()
         plt.savefig("data_plot.png")
-        plt.show()
         plt.close()
-    
-    def execute(self):
-        gdf = self._load_geojson()
-        polygon = gdf.geometry.iloc[0]
-        min_lon, min_lat, max_lon, max_lat = polygon.bounds
-        # print(f"Longitude range: {min_lon} to {max_lon}")
-        # print(f"Latitude range: {min_lat} to {max_lat}")
-        # geometry = geojson_data["features"][0]["geometry"]
-        # coords = self._extract_coordinates(geometry)
-        # min_lon, min_lat, max_lon, max_lat = self._create_boudning_box(coords[0])
-        print(f"Longitude range: {min_lon} to {max_lon}")
-        print(f"Latitude range: {min_lat} to {max_lat}")
-        raster = GetRasterExecutor(
-            variable=self.variable,
-            start_datetime=self.start_datetime,
-            end_datetime=self.end_datetime,
-            min_lat=min_lat,
-            max_lat=max_lat,
-            min_lon=min_lon,
-            max_lon=max_lon,
-            temporal_resolution=self.temporal_resolution,
-            spatial_resolution=self.spatial_resolution,
-            aggregation=self.aggregation
+
+    def _mask_counts(self, raster, masked_raster):
+        """
+        Return: valid points read and left after masking, equal counts mean the mask removed nothing.
+            Only the rectangles planned by _read_raster are read, not the whole bbox of the polygon
+        """
+        return {
+            "read_points": int(np.sum(~np.isnan(raster[self.variable_short_name].values))),
+            "masked_points": int(np.sum(~np.isnan(masked_raster[self.variable_short_name].values))),
+        }
+
+    def _cache_params(self):
+        return (
+            self.geojson_file,
+            os.path.getmtime(self.geojson_file),
+            self.per_feature,
+            self.zonal_method,
+            self.fractional,
         )
-        original_data = raster.execute()
-        masked_data = self._mask_raster_data(raster.execute(), polygon)
-        # print(masked_data)
-        self._visualize_mask(raster.execute(), masked_data, polygon)
-        original_count = np.sum(~np.isnan(original_data.t2m.values))
-        masked_count = np.sum(~np.isnan(masked_data.t2m.values))
-        
-        if original_count == masked_count:
-            print("Mask Failed: Same number of valid points before and after masking")
-        else:
-            print(f"Mask Succeeded: Reduced from {original_count} to {masked_count} points")
-        # masked_data = masked_data.dropna(dim="valid_time")
-        # fig, axs = plt.subplots(2, 2, figsize=(12, 10))
-        # axes_flat = axs.flatten()
-
-        # for i in range(4):
-        #     im = axes_flat[i].pcolormesh(masked_data.longitude, masked_data.latitude, masked_data["t2m"][i,:,:])
-        #     axes_flat[i].set_title(f'Slice {i}')
-            
-        # fig.colorbar(im, ax=axes_flat[0])
-        # fig.colorbar(im, ax=axes_flat[1])
-        # fig.colorbar(im, ax=axes_flat[2])
-        # fig.colorbar(im, ax=axes_flat[3])
-        # plt.tight_layout()
-        # plt.show()
+
+    def _use_result_cache(self):
+        # diagnostics are wanted on every call, do not serve it from the result cache
+        return not self.debug
+
+    def _execute(self):
+        if self.per_feature or self.zonal_method is not None:
+            return self._execute_features()
+        # without per_feature, the features mask the raster as one region
+        features = self._load_features()
+        polygon = features[0] if len(features) == 1 else shapely.union_all(features)
+        min_lon, min_lat, max_lon, max_lat = self._bounds([polygon])
+        raster = self._read_raster([polygon])
+        with tracer.span("mask", min_lat=min_lat, max_lat=max_lat, min_lon=min_lon, max_lon=max_lon) as span:
+            masked_data = self._mask_raster_data(raster, polygon)
+            if self.debug:
+                span.set(**self._mask_counts(raster, masked_data))
+        if self.debug:
+            self._visualize_mask(raster, masked_data, polygon)
         return masked_data
         
\ No newline at end of file
@@ -1,14 +1,19 @@
 from datetime import datetime
 import math
 import cdsapi
+import dask
 import pandas as pd
 import xarray as xr
 
 from .query_executor import QueryExecutor
-from .utils.const import time_resolution_to_freq
+from .utils.const import get_lat_weights, time_resolution_to_freq
+from .utils.dataset_pool import dataset_pool
+from .utils.tracing import tracer
 
 
 class GetRasterExecutor(QueryExecutor):
+    LAZY_CHUNKS = {"valid_time": "auto"}
+
     def __init__(
         self,
         variable: str,
@@ -58,12 +63,12 @@ class GetRasterExecutor(QueryExecutor):
         local_files = df_overlap["file_path"].tolist()
         api_calls = []
         if leftover is not None:
-            leftover_min_lat = math.floor(leftover.latitude.min().item())
-            leftover_max_lat = math.ceil(leftover.latitude.max().item())
-            leftover_min_lon = math.floor(leftover.longitude.min().item())
-            leftover_max_lon = math.ceil(leftover.longitude.max().item())
-            leftover_start_datetime = pd.Timestamp(leftover.time.min().item())
-            leftover_end_datetime = pd.Timestamp(leftover.time.max().item())
+            leftover_min_lat = math.floor(min(box["min_lat"] for box in leftover))
+            leftover_max_lat = math.ceil(max(box["max_lat"] for box in leftover))
+            leftover_min_lon = math.floor(min(box["min_lon"] for box in leftover))
+            leftover_max_lon = math.ceil(max(box["max_lon"] for box in leftover))
+            leftover_start_datetime = pd.Timestamp(min(box["start_datetime"] for box in leftover))
+            leftover_end_datetime = pd.Timestamp(max(box["end_datetime"] for box in leftover))
             leftover_start_year, leftover_start_month, leftover_start_day = (
                 leftover_start_datetime.year,
                 leftover_start_datetime.month,
@@ -101,17 +106,25 @@ class GetRasterExecutor(QueryExecutor):
             }
             api_calls.append((dataset, request))
         local_files = sorted(local_files)
-        print("local files:", local_files)
-        print("api:", api_calls)
         return local_files, api_calls
 
     def _gen_download_file_name(self):
         dt = datetime.now().strftime("%Y%m%d_%H%M%S")
         return f"download_{dt}.nc"
 
-    def execute(self):
+    def _read_datasets(self):
+        """
+        Return: [xarray.Dataset], one lazily-loaded selection per source file
+        """
         # 1. check metadata
-        file_list, api = self._check_metadata()
+        with tracer.span(
+            "metadata_lookup",
+            temporal_resolution=self.temporal_resolution,
+            spatial_resolution=self.spatial_resolution,
+            aggregation=self.aggregation,
+        ) as span:
+            file_list, api = self._check_metadata()
+            span.set(files=len(file_list), api_calls=len(api))
 
         # 2. call apis
         download_file_list = []
@@ -126,60 +139,133 @@ class GetRasterExecutor(QueryExecutor):
         ds_list = []
         # 3.1 read downloaded files
         for file in download_file_list:
-            ds = xr.open_dataset(file, engine="netcdf4")
+            with tracer.span("file_open", path=file, files=1):
+                ds = xr.open_dataset(file, engine="netcdf4")
             # drop unused variables
             # if "number" in ds.coords:
             #     ds = ds.drop_vars("number")
             # if "expver" in ds.coords:
             #     ds = ds.drop_vars("expver")
-            ds = ds.sel(
-                valid_time=slice(self.start_datetime, self.end_datetime),
-                latitude=slice(self.max_lat, self.min_lat),
-                longitude=slice(self.min_lon, self.max_lon),
-            )
+            with tracer.span("selection", path=file) as span:
+                ds = ds.sel(
+                    valid_time=slice(self.start_datetime, self.end_datetime),
+                    latitude=slice(self.max_lat, self.min_lat),
+                    longitude=slice(self.min_lon, self.max_lon),
+                )
+                span.set(bytes=ds.nbytes)
             # temporal resample
             if self.temporal_resolution != "hour":
-                resampled = ds.resample(valid_time=time_resolution_to_freq(self.temporal_resolution))
-                if self.aggregation == "mean":
-                    ds = resampled.mean()
-                elif self.aggregation == "max":
-                    ds = resampled.max()
-                elif self.aggregation == "min":
-                    ds = resampled.min()
-                else:
-                    raise ValueError("Invalid temporal_aggregation")
+                with tracer.span("resample", temporal_resolution=self.temporal_resolution):
+                    resampled = ds.resample(valid_time=time_resolution_to_freq(self.temporal_resolution))
+                    if self.aggregation == "mean":
+                        ds = resampled.mean()
+                    elif self.aggregation == "max":
+                        ds = resampled.max()
+                    elif self.aggregation == "min":
+                        ds = resampled.min()
+                    else:
+                        raise ValueError("Invalid temporal_aggregation")
             # spatial resample
             if self.spatial_resolution > 0.25:
-                c_f = int(self.spatial_resolution / 0.25)
-                coarsened = ds.coarsen(latitude=c_f, longitude=c_f, boundary="trim")
-                if self.aggregation == "mean":
-                    ds = coarsened.mean()
-                elif self.aggregation == "max":
-                    ds = coarsened.max()
-                elif self.aggregation == "min":
-                    ds = coarsened.min()
-                else:
-                    raise ValueError("Invalid spatial_aggregation")
+                with tracer.span("coarsen", spatial_resolution=self.spatial_resolution):
+                    c_f = int(self.spatial_resolution / 0.25)
+                    coarsened = ds.coarsen(latitude=c_f, longitude=c_f, boundary="trim")
+                    if self.aggregation == "mean":
+                        ds = coarsened.mean()
+                    elif self.aggregation == "max":
+                        ds = coarsened.max()
+                    elif self.aggregation == "min":
+                        ds = coarsened.min()
+                    else:
+                        raise ValueError("Invalid spatial_aggregation")
             ds_list.append(ds)
 
         # 3.2 read local files
         ds_list = []
         for file in file_list:
-            ds = xr.open_dataset(file, engine="netcdf4").sel(
-                valid_time=slice(self.start_datetime, self.end_datetime),
-                latitude=slice(self.max_lat, self.min_lat),
-                longitude=slice(self.min_lon, self.max_lon),
-            )
+            with tracer.span("file_open", path=file, files=1) as span:
+                hits = dataset_pool.hits
+                ds = dataset_pool.open(file)
+                span.set(pool_hit=dataset_pool.hits > hits)
+            with tracer.span("selection", path=file) as span:
+                ds = ds.sel(
+                    valid_time=slice(self.start_datetime, self.end_datetime),
+                    latitude=slice(self.max_lat, self.min_lat),
+                    longitude=slice(self.min_lon, self.max_lon),
+                )
+                span.set(bytes=ds.nbytes)
             ds_list.append(ds)
 
-        # 3.3 assemble result
-        # ds = xr.concat([i.chunk() for i in ds_list], dim="valid_time")
+        return ds_list
+
+    @staticmethod
+    def _merge(ds_list):
         # compat="override" is a temporal walkaround as pre-aggregation value conflicts with downloaded data
         # future solution: use new encoding when write pre-aggregated data
-        try:
-            ds = xr.merge([i.chunk() for i in ds_list], compat="no_conflicts")
-        except ValueError:
-            print("WARNING: conflict in merging data, use override")
-            ds = xr.merge([i.chunk() for i in ds_list], compat="override")
+        with tracer.span("merge", parts=len(ds_list)) as span:
+            try:
+                return xr.merge(ds_list, compat="no_conflicts")
+            except ValueError:
+                span.set(conflict=True)
+                return xr.merge(ds_list, compat="override")
+
+    @staticmethod
+    def _combine_partials(partials, method):
+        """
+        Combine per-file reductions, filling coordinates missing from a file with NaN
+        """
+        if not partials:
+            return xr.Dataset()
+        if len(partials) == 1:
+            return partials[0]
+        aligned = xr.align(*partials, join="outer")
+        return getattr(xr.concat(aligned, dim="partial"), method)(dim="partial")
+
+    def execute_lazy(self):
+        """
+        Return: xarray.Dataset backed by dask arrays, chunked along valid_time, not computed
+        """
+        return self._merge([i.chunk(self.LAZY_CHUNKS) for i in self._read_datasets()])
+
+    def _reduce(self, ds_list, dim, method, area_weighted=False):
+        if method == "mean" and area_weighted:
+            weights = [get_lat_weights(self.spatial_resolution, i["latitude"].values) for i in ds_list]
+            sums = self._combine_partials([(i * w).sum(dim) for i, w in zip(ds_list, weights)], "sum")
+            counts = self._combine_partials([(i.notnull() * w).sum(dim) for i, w in zip(ds_list, weights)], "sum")
+            return sums / counts
+        elif method == "mean":
+            sums = self._combine_partials([i.sum(dim) for i in ds_list], "sum")
+            counts = self._combine_partials([i.count(dim) for i in ds_list], "sum")
+            return sums / counts
+        elif method == "count":
+            return self._combine_partials([i.count(dim) for i in ds_list], "sum")
+        elif method in ("max", "min"):
+            return self._combine_partials([getattr(i, method)(dim) for i in ds_list], method)
+        else:
+            raise ValueError(f"Invalid reduction method: {method}")
+
+    def execute_reduced(self, dim, method, area_weighted=False):
+        """
+        Return: self.execute() reduced over dim with method ("mean", "max", "min", "count"), loaded in memory
+            method may also be a list of methods: they share one pass over the raster,
+            and a {method: xarray.Dataset} dict is returned
+            area_weighted: weight "mean" by cos(latitude) cell area (see utils.const.get_lat_weights)
+
+        The reduction is pushed into every file's chunks before the files are combined,
+        so peak memory follows the reduced output rather than the raster.
+        Source files are assumed not to overlap, otherwise "mean" counts the overlap twice.
+        """
+        ds_list = [i.chunk(self.LAZY_CHUNKS) for i in self._read_datasets()]
+        if isinstance(method, str):
+            reduced = self._reduce(ds_list, dim, method, area_weighted)
+            with tracer.span("compute", method=method):
+                return reduced.compute()
+        reduced = [self._reduce(ds_list, dim, m, area_weighted) for m in method]
+        with tracer.span("compute", method=list(method)):
+            reduced = dask.compute(*reduced)
+        return dict(zip(method, reduced))
 
-        return ds.compute()
+    def _execute(self):
+        raster = self.execute_lazy()
+        with tracer.span("compute"):
+            return raster.compute()
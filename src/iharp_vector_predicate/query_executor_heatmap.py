@@ -1,17 +1,25 @@
-import numpy as np
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
 import xarray as xr
 
 from .query_executor import QueryExecutor
 from .query_executor_get_raster import GetRasterExecutor
+from .utils.accumulator import StreamingAccumulator
+from .utils.const import get_lat_weights
 from .utils.get_whole_period import (
-    get_whole_ranges_between,
-    get_total_hours_in_year,
-    get_total_hours_in_month,
-    iterate_months,
-    number_of_days_inclusive,
-    number_of_hours_inclusive,
-    get_total_hours_between,
+    PYRAMID_LEVELS,
+    from_epoch_hours,
+    get_available_ranges_between,
+    get_period_hours,
+    to_epoch_hours,
 )
+from .utils.tracing import Span, tracer
+
+# process pools shared by every HeatmapExecutor, per max_workers: starting spawned workers costs seconds
+_process_pools = {}
+_process_pools_lock = threading.Lock()
 
 
 class HeatmapExecutor(QueryExecutor):
@@ -28,6 +36,8 @@ class HeatmapExecutor(QueryExecutor):
         aggregation,  # e.g., "mean", "max", "min"
         heatmap_aggregation_method: str,  # e.g., "mean", "max", "min"
         metadata=None,  # metadata file path
+        parallel=None,  # None (sequential), "thread" or "process": run pyramid sub-queries concurrently
+        max_workers=None,  # worker count for parallel, default decided by concurrent.futures
     ):
         super().__init__(
             variable,
@@ -43,245 +53,186 @@ class HeatmapExecutor(QueryExecutor):
             metadata=metadata,
         )
         self.heatmap_aggregation_method = heatmap_aggregation_method
+        self.parallel = parallel
+        self.max_workers = max_workers
+        self._sub_queries = None
 
-    def execute(self):
-        if self.heatmap_aggregation_method == "mean":
-            return self._get_mean_heatmap().compute()
-        elif self.heatmap_aggregation_method == "max":
-            return self._get_max_heatmap().compute()
-        elif self.heatmap_aggregation_method == "min":
-            return self._get_min_heatmap().compute()
-        else:
+    def _cache_params(self):
+        return (self.heatmap_aggregation_method,)
+
+    def _execute(self):
+        if self.heatmap_aggregation_method not in ("mean", "max", "min"):
             raise ValueError("Invalid heatmap_aggregation_method")
+        heatmap = self._get_heatmap()
+        with tracer.span("compute"):
+            return heatmap.compute()
 
-    def _get_mean_heatmap(self):
-        year_range, month_range, day_range, hour_range = get_whole_ranges_between(
-            self.start_datetime, self.end_datetime
-        )
-        ds_year = []
-        ds_month = []
-        ds_day = []
-        ds_hour = []
-        year_hours = []
-        month_hours = []
-        day_hours = []
-        hour_hours = []
-        for start_year, end_year in year_range:
-            get_raster_year = GetRasterExecutor(
-                self.variable,
-                str(start_year),
-                str(end_year),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="year",
-                spatial_resolution=self.spatial_resolution,
-                aggregation=self.heatmap_aggregation_method,
-                metadata=self.metadata.f_path,
-            )
-            ds_year.append(get_raster_year.execute())
-            year_hours += [get_total_hours_in_year(y) for y in range(start_year.year, end_year.year + 1)]
-        for start_month, end_month in month_range:
-            get_raster_month = GetRasterExecutor(
-                self.variable,
-                str(start_month),
-                str(end_month),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="month",
-                spatial_resolution=self.spatial_resolution,
-                aggregation=self.heatmap_aggregation_method,
-                metadata=self.metadata.f_path,
-            )
-            ds_month.append(get_raster_month.execute())
-            month_hours += [get_total_hours_in_month(m) for m in iterate_months(start_month, end_month)]
-        for start_day, end_day in day_range:
-            get_raster_day = GetRasterExecutor(
-                self.variable,
-                str(start_day),
-                str(end_day),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="day",
-                spatial_resolution=self.spatial_resolution,
-                aggregation=self.heatmap_aggregation_method,
-                metadata=self.metadata.f_path,
-            )
-            ds_day.append(get_raster_day.execute())
-            day_hours += [24 for _ in range(number_of_days_inclusive(start_day, end_day))]
-        for start_hour, end_hour in hour_range:
-            get_raster_hour = GetRasterExecutor(
-                self.variable,
-                str(start_hour),
-                str(end_hour),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="hour",
-                spatial_resolution=self.spatial_resolution,
-                aggregation=self.aggregation,
-                metadata=self.metadata.f_path,
+    def execute_area_weighted_mean(self):
+        """
+        Return: xarray.Dataset of the mean over the whole query range and area, weighting time by hours
+        (as in the mean heatmap, served from the year/month/day pre-aggregates) and cells by cos(latitude)
+        """
+        if self.heatmap_aggregation_method != "mean":
+            raise ValueError("Area-weighted mean requires heatmap_aggregation_method 'mean'")
+        hm = self.execute()
+        weights = get_lat_weights(self.spatial_resolution, hm["latitude"].values)
+        return hm.weighted(weights).mean(dim=["latitude", "longitude"])
+
+    def _candidate_sub_queries(self):
+        """
+        Return: {plan name: [(GetRasterExecutor kwargs, hourly weight of each time step)]}, decomposed once
+            pyramid: year / month / day pre-aggregates of whole periods, hours for the rest
+            hourly: one read of the whole range at hour, only when it reduces to the same heatmap
+        """
+        if self._sub_queries is None:
+            sub_queries = {"pyramid": self._gen_pyramid_sub_queries()}
+            if self.spatial_resolution == 0.25 or self.aggregation == self.heatmap_aggregation_method:
+                sub_queries["hourly"] = self._gen_hourly_sub_queries()
+            self._sub_queries = sub_queries
+        return self._sub_queries
+
+    def _candidate_plans(self):
+        return {
+            name: [(GetRasterExecutor(**raster_kwargs), 1) for raster_kwargs, _ in sub_queries]
+            for name, sub_queries in self._candidate_sub_queries().items()
+        }
+
+    def _gen_sub_queries(self):
+        """
+        Return: [(GetRasterExecutor kwargs, hourly weight of each time step)] of the chosen plan
+        """
+        return self._candidate_sub_queries()[self._choose_plan()]
+
+    def _gen_hourly_sub_queries(self):
+        return [
+            (
+                self._gen_raster_kwargs(self.start_datetime, self.end_datetime, "hour", self.aggregation),
+                get_period_hours(to_epoch_hours(self.start_datetime), to_epoch_hours(self.end_datetime), "hour"),
             )
-            ds_hour.append(get_raster_hour.execute())
-            hour_hours += [1 for _ in range(number_of_hours_inclusive(start_hour, end_hour))]
+        ]
 
-        xrds_concat = xr.concat(ds_year + ds_month + ds_day + ds_hour, dim="valid_time")
-        nd_array = xrds_concat[self.variable_short_name].to_numpy()
-        weights = np.array(year_hours + month_hours + day_hours + hour_hours)
-        total_hours = get_total_hours_between(self.start_datetime, self.end_datetime)
-        weights = weights / total_hours
-        average = np.average(nd_array, axis=0, weights=weights)
-        res = xr.Dataset(
-            {self.variable_short_name: (["latitude", "longitude"], average)},
-            coords={"latitude": xrds_concat.latitude, "longitude": xrds_concat.longitude},
+    def _gen_pyramid_sub_queries(self):
+        """
+        Return: [(GetRasterExecutor kwargs, hourly weight of each time step)], one per pyramid level range,
+            periods whose pre-aggregates are missing from the metadata are read from the next finer level
+        """
+        with tracer.span("decompose") as span:
+            level_ranges = get_available_ranges_between(self.start_datetime, self.end_datetime, self._is_covered)
+            span.set(**{f"{level}_ranges": len(ranges) for level, ranges in zip(PYRAMID_LEVELS, level_ranges)})
+        sub_queries = []
+        for temporal_resolution, ranges in zip(PYRAMID_LEVELS, level_ranges):
+            aggregation = self.aggregation if temporal_resolution == "hour" else self.heatmap_aggregation_method
+            for start, end in ranges.tolist():
+                sub_queries.append(
+                    (
+                        self._gen_raster_kwargs(
+                            from_epoch_hours(start), from_epoch_hours(end), temporal_resolution, aggregation
+                        ),
+                        get_period_hours(start, end, temporal_resolution),
+                    )
+                )
+        return sub_queries
+
+    def _is_covered(self, start, end, temporal_resolution):
+        _, leftover = self.metadata.query_get_overlap_and_leftover(
+            self.variable,
+            start,
+            end,
+            self.min_lat,
+            self.max_lat,
+            self.min_lon,
+            self.max_lon,
+            temporal_resolution,
+            self.spatial_resolution,
+            self.heatmap_aggregation_method,
         )
-        return res
+        return leftover is None
 
-    def _get_max_heatmap(self):
-        year_range, month_range, day_range, hour_range = get_whole_ranges_between(
-            self.start_datetime, self.end_datetime
+    def _gen_raster_kwargs(self, start, end, temporal_resolution, aggregation):
+        return dict(
+            variable=self.variable,
+            start_datetime=str(start),
+            end_datetime=str(end),
+            min_lat=self.min_lat,
+            max_lat=self.max_lat,
+            min_lon=self.min_lon,
+            max_lon=self.max_lon,
+            temporal_resolution=temporal_resolution,
+            spatial_resolution=self.spatial_resolution,
+            aggregation=aggregation,
+            metadata=self.metadata.f_path,
         )
-        ds_year = []
-        ds_month = []
-        ds_day = []
-        ds_hour = []
-        for start_year, end_year in year_range:
-            get_raster_year = GetRasterExecutor(
-                self.variable,
-                str(start_year),
-                str(end_year),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="year",
-                spatial_resolution=self.spatial_resolution,
-                aggregation=self.heatmap_aggregation_method,
-                metadata=self.metadata.f_path,
-            )
-            ds_year.append(get_raster_year.execute())
-        for start_month, end_month in month_range:
-            get_raster_month = GetRasterExecutor(
-                self.variable,
-                str(start_month),
-                str(end_month),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="month",
-                spatial_resolution=self.spatial_resolution,
-                aggregation=self.heatmap_aggregation_method,
-                metadata=self.metadata.f_path,
-            )
-            ds_month.append(get_raster_month.execute())
-        for start_day, end_day in day_range:
-            get_raster_day = GetRasterExecutor(
-                self.variable,
-                str(start_day),
-                str(end_day),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="day",
-                spatial_resolution=self.spatial_resolution,
-                aggregation=self.heatmap_aggregation_method,
-                metadata=self.metadata.f_path,
-            )
-            ds_day.append(get_raster_day.execute())
-        for start_hour, end_hour in hour_range:
-            get_raster_hour = GetRasterExecutor(
-                self.variable,
-                str(start_hour),
-                str(end_hour),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="hour",
-                spatial_resolution=self.spatial_resolution,
-                aggregation=self.aggregation,
-                metadata=self.metadata.f_path,
-            )
-            ds_hour.append(get_raster_hour.execute())
 
-        return xr.concat(ds_year + ds_month + ds_day + ds_hour, dim="valid_time").max(dim="valid_time")
+    def _execute_sub_queries(self, sub_queries):
+        """
+        Yield: (position in sub_queries, sub-raster reduced over time) in completion order
+        """
+        reduce_method = self.heatmap_aggregation_method
+        if self.parallel is None:
+            for i, (raster_kwargs, weights) in enumerate(sub_queries):
+                yield i, _execute_sub_query(raster_kwargs, reduce_method, weights)
+            return
+        if self.parallel == "thread":
+            # spans of worker threads join the current trace
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = {
+                    pool.submit(tracer.bind(_execute_sub_query), raster_kwargs, reduce_method, weights): i
+                    for i, (raster_kwargs, weights) in enumerate(sub_queries)
+                }
+                for future in as_completed(futures):
+                    yield futures[future], future.result()
+        elif self.parallel == "process":
+            pool = _get_process_pool(self.max_workers)
+            futures = {
+                pool.submit(_execute_sub_query_traced, raster_kwargs, reduce_method, weights): i
+                for i, (raster_kwargs, weights) in enumerate(sub_queries)
+            }
+            for future in as_completed(futures):
+                partial, span = future.result()
+                tracer.attach(Span.from_dict(span))
+                yield futures[future], partial
+        else:
+            raise ValueError(f"Invalid parallel mode: {self.parallel}")
+
+    def _get_heatmap(self):
+        """
+        Fold every pyramid sub-raster into a running max / min / weighted mean as it finishes,
+        without holding the sub-rasters together
+        """
+        sub_queries = self._gen_sub_queries()
+        accumulator = StreamingAccumulator(self.heatmap_aggregation_method)
+        for i, partial in self._execute_sub_queries(sub_queries):
+            with tracer.span("merge", parts=1):
+                accumulator.add(partial, weight=sub_queries[i][1].sum())
+        return accumulator.result()
+
+
+def _get_process_pool(max_workers):
+    """
+    Return: ProcessPoolExecutor kept for the life of the process
+        spawn, not fork: forking while dask / netCDF threads of this process hold locks can hang the workers
+    """
+    with _process_pools_lock:
+        pool = _process_pools.get(max_workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+            _process_pools[max_workers] = pool
+        return pool
+
+
+def _execute_sub_query_traced(raster_kwargs, reduce_method, weights):
+    # runs in a worker process, its span is returned to join the submitting trace (see Tracer.attach)
+    with tracer.span("sub_query") as span:
+        partial = _execute_sub_query(raster_kwargs, reduce_method, weights)
+    return partial, span.to_dict()
 
-    def _get_min_heatmap(self):
-        year_range, month_range, day_range, hour_range = get_whole_ranges_between(
-            self.start_datetime, self.end_datetime
-        )
-        ds_year = []
-        ds_month = []
-        ds_day = []
-        ds_hour = []
-        for start_year, end_year in year_range:
-            get_raster_year = GetRasterExecutor(
-                self.variable,
-                str(start_year),
-                str(end_year),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="year",
-                spatial_resolution=self.spatial_resolution,
-                aggregation=self.heatmap_aggregation_method,
-                metadata=self.metadata.f_path,
-            )
-            ds_year.append(get_raster_year.execute())
-        for start_month, end_month in month_range:
-            get_raster_month = GetRasterExecutor(
-                self.variable,
-                str(start_month),
-                str(end_month),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="month",
-                spatial_resolution=self.spatial_resolution,
-                aggregation=self.heatmap_aggregation_method,
-                metadata=self.metadata.f_path,
-            )
-            ds_month.append(get_raster_month.execute())
-        for start_day, end_day in day_range:
-            get_raster_day = GetRasterExecutor(
-                self.variable,
-                str(start_day),
-                str(end_day),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="day",
-                spatial_resolution=self.spatial_resolution,
-                aggregation=self.heatmap_aggregation_method,
-                metadata=self.metadata.f_path,
-            )
-            ds_day.append(get_raster_day.execute())
-        for start_hour, end_hour in hour_range:
-            get_raster_hour = GetRasterExecutor(
-                self.variable,
-                str(start_hour),
-                str(end_hour),
-                self.min_lat,
-                self.max_lat,
-                self.min_lon,
-                self.max_lon,
-                temporal_resolution="hour",
-                spatial_resolution=self.spatial_resolution,
-                aggregation=self.aggregation,
-                metadata=self.metadata.f_path,
-            )
-            ds_hour.append(get_raster_hour.execute())
 
-        # get min heatmap from ds_year, ds_month, ds_day, ds_hour
-        return xr.concat(ds_year + ds_month + ds_day + ds_hour, dim="valid_time").min(dim="valid_time")
+def _execute_sub_query(raster_kwargs, reduce_method, weights):
+    # module level so that process pools can pickle it
+    get_raster = GetRasterExecutor(**raster_kwargs)
+    if reduce_method == "mean":
+        raster = get_raster.execute_lazy()
+        weighted = raster * xr.DataArray(weights, dims="valid_time")
+        with tracer.span("compute", method=reduce_method):
+            return weighted.sum(dim="valid_time", skipna=False).compute()
+    return get_raster.execute_reduced("valid_time", reduce_method)
@@ -1,5 +1,12 @@
+import numpy as np
+
+from .metadata import subtract_box
 from .query_executor import *
 from .query_executor_get_raster import GetRasterExecutor
+from .utils.const import get_lat_lon_range
+
+# coarser grids whose max / min pre-aggregates may answer whole cells of a max / min series, coarsest first
+PUSHDOWN_SPATIAL_RESOLUTIONS = [1.0, 0.5]
 
 
 class TimeseriesExecutor(QueryExecutor):
@@ -16,6 +23,7 @@ class TimeseriesExecutor(QueryExecutor):
         aggregation,  # e.g., "mean", "max", "min"
         time_series_aggregation_method: str,  # e.g., "mean", "max", "min"
         metadata=None,  # metadata file path
+        area_weighted: bool = False,  # weight "mean" over lat/lon by cos(latitude) cell area
     ):
         super().__init__(
             variable=variable,
@@ -31,9 +39,46 @@ class TimeseriesExecutor(QueryExecutor):
             metadata=metadata,
         )
         self.time_series_aggregation_method = time_series_aggregation_method
+        self.area_weighted = area_weighted
+        self._pushdown_plans = None
+
+    def _cache_params(self):
+        if isinstance(self.time_series_aggregation_method, str):
+            return (self.time_series_aggregation_method, self.area_weighted)
+        # a list of methods names the variables after each method (see _assemble), even with one method
+        return ("list",) + tuple(self.time_series_aggregation_method) + (self.area_weighted,)
+
+    def _get_methods(self):
+        if isinstance(self.time_series_aggregation_method, str):
+            methods = [self.time_series_aggregation_method]
+        else:
+            methods = list(self.time_series_aggregation_method)
+        for method in methods:
+            if method not in ("mean", "max", "min", "count"):
+                raise ValueError(f"Invalid time series aggregation method: {method}")
+        return methods
 
-    def execute(self):
-        get_raster_executor = GetRasterExecutor(
+    def _get_read_groups(self, methods=None):
+        """
+        Return: {aggregation of the files to read: [methods computed from them]}
+        """
+        # methods sharing the same pre-aggregated files are computed in one pass over them;
+        # at hour resolution every method reads the raw files
+        methods = self._get_methods() if methods is None else methods
+        groups = {}
+        for method in methods:
+            if self.temporal_resolution == "hour":
+                aggregation = NO_AGG_LIT
+            elif method == "count":
+                # any pre-aggregate has the same valid cells, share the read of another method
+                aggregation = next((m for m in methods if m != "count"), "mean")
+            else:
+                aggregation = method
+            groups.setdefault(aggregation, []).append(method)
+        return groups
+
+    def _get_raster_executor(self, aggregation):
+        return GetRasterExecutor(
             variable=self.variable,
             start_datetime=self.start_datetime,
             end_datetime=self.end_datetime,
@@ -43,15 +88,166 @@ class TimeseriesExecutor(QueryExecutor):
             max_lon=self.max_lon,
             temporal_resolution=self.temporal_resolution,
             spatial_resolution=0.25,
-            aggregation=self.time_series_aggregation_method,
+            aggregation=aggregation,
             metadata=self.metadata.f_path,
         )
-        raster = get_raster_executor.execute()
-        if self.time_series_aggregation_method == "mean":
-            return raster.mean(dim=["latitude", "longitude"]).compute()
-        elif self.time_series_aggregation_method == "max":
-            return raster.max(dim=["latitude", "longitude"]).compute()
-        elif self.time_series_aggregation_method == "min":
-            return raster.min(dim=["latitude", "longitude"]).compute()
-        else:
-            raise ValueError(f"Invalid time series aggregation method: {self.time_series_aggregation_method}")
+
+    def _get_pushdown_plans(self):
+        """
+        Return: {method: pieces (see _plan_pushdown)} of the methods answered from coarser pre-aggregates,
+            planned once
+        """
+        if self._pushdown_plans is None:
+            plans = {}
+            for method in self._get_methods():
+                if method in ("max", "min"):
+                    pieces = self._plan_pushdown(method)
+                    if pieces is not None:
+                        plans[method] = pieces
+            self._pushdown_plans = plans
+        return self._pushdown_plans
+
+    def _get_reads(self, pushdown_plans):
+        """
+        Return: [(GetRasterExecutor, [methods reduced from it])]
+        """
+        reads = []
+        for method, pieces in pushdown_plans.items():
+            reads.extend((e, [method]) for e in self._get_pushdown_executors(method, pieces))
+        rest = [m for m in self._get_methods() if m not in pushdown_plans]
+        for aggregation, group_methods in self._get_read_groups(rest).items():
+            reads.append((self._get_raster_executor(aggregation), group_methods))
+        return reads
+
+    def _candidate_plans(self):
+        """
+        baseline: one 0.25 read per read group
+        pushdown: max / min from coarser pre-aggregates where possible (see _plan_pushdown)
+        """
+        plans = {"baseline": [(e, 1) for e, _ in self._get_reads({})]}
+        pushdown_plans = self._get_pushdown_plans()
+        if pushdown_plans:
+            plans["pushdown"] = [(e, 1) for e, _ in self._get_reads(pushdown_plans)]
+        return plans
+
+    def _execute(self):
+        pushdown_plans = self._get_pushdown_plans() if self._choose_plan() == "pushdown" else {}
+        reduced = {}
+        for method, pieces in pushdown_plans.items():
+            partials = [
+                e.execute_reduced(["latitude", "longitude"], method)
+                for e in self._get_pushdown_executors(method, pieces)
+            ]
+            reduced[method] = GetRasterExecutor._combine_partials(partials, method)
+        rest = [m for m in self._get_methods() if m not in reduced]
+        for aggregation, group_methods in self._get_read_groups(rest).items():
+            get_raster_executor = self._get_raster_executor(aggregation)
+            reduced.update(
+                get_raster_executor.execute_reduced(
+                    ["latitude", "longitude"], group_methods, area_weighted=self.area_weighted
+                )
+            )
+        return self._assemble(reduced)
+
+    def _plan_pushdown(self, method):
+        """
+        Max / min over a region equal the max / min over coarse cells of the same aggregation when
+        the cells lie wholly inside it. The bbox is split into the whole coarse cells of the coarsest
+        level covering them (if its files are in the metadata) and rims, planned the same way with
+        the finer levels and read at 0.25 at last.
+        Return: [(spatial_resolution, min_lat, max_lat, min_lon, max_lon)] to read,
+            None when no coarser level holds a whole cell of the bbox
+        """
+        lat_start, lat_end, lon_start, lon_end = get_lat_lon_index_range(
+            0.25, self.min_lat, self.max_lat, self.min_lon, self.max_lon
+        )
+        if lat_start >= lat_end or lon_start >= lon_end:
+            return None
+        pieces = self._plan_box(method, ((lat_start, lat_end), (lon_start, lon_end)), PUSHDOWN_SPATIAL_RESOLUTIONS)
+        if all(piece[0] == 0.25 for piece in pieces):
+            return None
+        return pieces
+
+    def _plan_box(self, method, box, levels):
+        lat_range, lon_range, _ = get_lat_lon_range(0.25)
+        for i, spatial_resolution in enumerate(levels):
+            core = self._coarse_core(box, spatial_resolution)
+            if core is None:
+                continue
+            (lat_cell_start, lat_cell_end), (lon_cell_start, lon_cell_end), raw_core = core
+            coarse_lat_range, coarse_lon_range, _ = get_lat_lon_range(spatial_resolution)
+            bbox = (
+                coarse_lat_range[lat_cell_start],
+                coarse_lat_range[lat_cell_end - 1],
+                coarse_lon_range[lon_cell_start],
+                coarse_lon_range[lon_cell_end - 1],
+            )
+            _, leftover = self.metadata.query_get_overlap_and_leftover(
+                self.variable,
+                self.start_datetime,
+                self.end_datetime,
+                *bbox,
+                self.temporal_resolution,
+                spatial_resolution,
+                method,
+            )
+            if leftover is not None:
+                continue
+            pieces = [(spatial_resolution,) + bbox]
+            for rim in subtract_box(box, raw_core):
+                pieces.extend(self._plan_box(method, rim, levels[i + 1 :]))
+            return pieces
+        (lat_start, lat_end), (lon_start, lon_end) = box
+        return [(0.25, lat_range[lat_start], lat_range[lat_end - 1], lon_range[lon_start], lon_range[lon_end - 1])]
+
+    @staticmethod
+    def _coarse_core(box, spatial_resolution):
+        """
+        box: ((lat_start, lat_end), (lon_start, lon_end)) half-open index ranges on the 0.25 grid
+        Return: (lat cell range, lon cell range, covered box on the 0.25 grid) of the cells of spatial_resolution
+            lying wholly inside box, None if there is none.
+            A coarse cell covers the 0.25 points within spatial_resolution / 2 - 0.125 of its center (see utils.const)
+        """
+        factor = int(spatial_resolution / 0.25)
+        cells, covered = [], []
+        for axis, (start, end) in enumerate(box):
+            raw_range = get_lat_lon_range(0.25)[axis]
+            coarse_range = get_lat_lon_range(spatial_resolution)[axis]
+            first = np.rint((coarse_range - (spatial_resolution / 2 - 0.125) - raw_range[0]) / 0.25).astype(int)
+            inside = np.flatnonzero((first >= start) & (first + factor <= end))
+            if inside.size == 0:
+                return None
+            cells.append((inside[0], inside[-1] + 1))
+            covered.append((first[inside[0]], first[inside[-1]] + factor))
+        return cells[0], cells[1], tuple(covered)
+
+    def _get_pushdown_executors(self, method, pieces):
+        return [
+            GetRasterExecutor(
+                variable=self.variable,
+                start_datetime=self.start_datetime,
+                end_datetime=self.end_datetime,
+                min_lat=min_lat,
+                max_lat=max_lat,
+                min_lon=min_lon,
+                max_lon=max_lon,
+                temporal_resolution=self.temporal_resolution,
+                spatial_resolution=spatial_resolution,
+                aggregation=method,
+                metadata=self.metadata.f_path,
+            )
+            for spatial_resolution, min_lat, max_lat, min_lon, max_lon in pieces
+        ]
+
+    def _assemble(self, reduced):
+        """
+        reduced: {method: xarray.Dataset reduced over lat/lon}
+        """
+        if isinstance(self.time_series_aggregation_method, str):
+            return reduced[self.time_series_aggregation_method]
+        # several methods: one data variable per method, e.g. t2m_min, t2m_max
+        return xr.merge(
+            [reduced[m].rename({v: f"{v}_{m}" for v in reduced[m].data_vars}) for m in self._get_methods()],
+            compat="override",
+            join="outer",
+        )
@@ -0,0 +1,41 @@
+import numpy as np
+import xarray as xr
+
+
+class StreamingAccumulator:
+    """
+    Running max / min / weighted mean over partial results that share one lat/lon output grid.
+    Partials are folded in as they arrive, so memory stays O(output grid).
+
+    Partials are already reduced over time:
+        - "max" / "min": max / min of the partial over time
+        - "mean": weighted sum of the partial over time, added with the sum of its weights
+    """
+
+    def __init__(self, method):
+        if method not in ("mean", "max", "min"):
+            raise ValueError(f"Invalid accumulation method: {method}")
+        self.method = method
+        self.value = None
+        self.weight = 0
+
+    def add(self, partial, weight=0):
+        if self.method == "mean":
+            self.weight += weight
+        if self.value is None:
+            self.value = partial
+            return
+        value, partial = xr.align(self.value, partial, join="outer")
+        if self.method == "mean":
+            self.value = value + partial
+        elif self.method == "max":
+            self.value = np.fmax(value, partial)
+        else:
+            self.value = np.fmin(value, partial)
+
+    def result(self):
+        if self.value is None:
+            raise ValueError("No partial result accumulated")
+        if self.method == "mean":
+            return self.value / self.weight
+        return self.value
@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 import numpy as np
 import xarray as xr
 
@@ -25,21 +27,54 @@ ds_05 = ds_raw.coarsen(latitude=2, longitude=2, boundary="trim").max()
 ds_10 = ds_raw.coarsen(latitude=4, longitude=4, boundary="trim").max()
 
 
+# ascending (latitude, longitude) grid of each spatial resolution
+_lat_lon_grids = {
+    0.25: (ds_raw.latitude.values, ds_raw.longitude.values),
+    0.5: (ds_05.latitude.values, ds_05.longitude.values),
+    1.0: (ds_10.latitude.values, ds_10.longitude.values),
+}
+
+
 def get_lat_lon_range(spatial_resolution):
-    if spatial_resolution == 0.25:
-        lat_range = ds_raw.latitude.values
-        lon_range = ds_raw.longitude.values
-    elif spatial_resolution == 0.5:
-        lat_range = ds_05.latitude.values
-        lon_range = ds_05.longitude.values
-    elif spatial_resolution == 1.0:
-        lat_range = ds_10.latitude.values
-        lon_range = ds_10.longitude.values
-    else:
+    grid = _lat_lon_grids.get(spatial_resolution)
+    if grid is None:
         raise ValueError("Invalid spatial_resolution")
+    lat_range, lon_range = grid
     return lat_range, lon_range, lat_range[::-1]
 
 
+def get_lat_lon_index_range(spatial_resolution, min_lat, max_lat, min_lon, max_lon):
+    """
+    Return: (lat_start, lat_end, lon_start, lon_end), half-open index ranges
+    into the ascending lat/lon grids of get_lat_lon_range
+    """
+    lat_range, lon_range, _ = get_lat_lon_range(spatial_resolution)
+    lat_start = lat_range.searchsorted(min_lat, side="left")
+    lat_end = lat_range.searchsorted(max_lat, side="right")
+    lon_start = lon_range.searchsorted(min_lon, side="left")
+    lon_end = lon_range.searchsorted(max_lon, side="right")
+    return lat_start, lat_end, lon_start, lon_end
+
+
+@lru_cache(maxsize=None)
+def _get_lat_weight_vector(spatial_resolution):
+    lat_range, _, _ = get_lat_lon_range(spatial_resolution)
+    return np.cos(np.deg2rad(lat_range))
+
+
+def get_lat_weights(spatial_resolution, latitude):
+    """
+    Return: xarray.DataArray of cos(latitude) cell-area weights along the given latitude coordinate,
+    looked up in the weight vector cached per grid
+    """
+    lat_range, _, _ = get_lat_lon_range(spatial_resolution)
+    latitude = np.asarray(latitude)
+    idx = np.clip(np.rint((latitude - lat_range[0]) / spatial_resolution).astype(int), 0, len(lat_range) - 1)
+    return xr.DataArray(
+        _get_lat_weight_vector(spatial_resolution)[idx], dims="latitude", coords={"latitude": latitude}
+    )
+
+
 def time_resolution_to_freq(time_resolution):
     if time_resolution == "hour":
         return "h"
@@ -0,0 +1,82 @@
+import os
+import threading
+from collections import OrderedDict
+
+from .storage import get_backend
+
+DEFAULT_MAX_OPEN = 64
+
+
+class DatasetPool:
+    """
+    Process-wide LRU of opened datasets, keyed by (path, mtime).
+    Paths are opened with the storage backend matching them (see utils.storage).
+
+    Returned datasets are shared between executors: select from them, never close or modify them.
+    An evicted dataset is closed; views taken from it reopen the file on access.
+    """
+
+    def __init__(self, max_open=DEFAULT_MAX_OPEN):
+        self.max_open = max_open
+        self.hits = 0
+        self.misses = 0
+        self._datasets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def open(self, path):
+        backend = get_backend(path)
+        key = (os.path.abspath(path), backend.version(path))
+        with self._lock:
+            ds = self._datasets.get(key)
+            if ds is not None:
+                self._datasets.move_to_end(key)
+                self.hits += 1
+                return ds
+
+        ds = backend.open(path)
+        with self._lock:
+            existing = self._datasets.get(key)
+            if existing is not None:
+                ds.close()
+                self._datasets.move_to_end(key)
+                self.hits += 1
+                return existing
+            # drop handles on older versions of the same file
+            for stale in [k for k in self._datasets if k[0] == key[0]]:
+                self._datasets.pop(stale).close()
+            self._datasets[key] = ds
+            self.misses += 1
+            self._evict()
+        return ds
+
+    def is_open(self, path):
+        """
+        Return: whether open(path) would be served from the pool, without opening it
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            if not any(k[0] == path for k in self._datasets):
+                return False
+        try:
+            version = get_backend(path).version(path)
+        except OSError:
+            return False
+        with self._lock:
+            return (path, version) in self._datasets
+
+    def set_max_open(self, max_open):
+        with self._lock:
+            self.max_open = max_open
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            while self._datasets:
+                self._datasets.popitem(last=False)[1].close()
+
+    def _evict(self):
+        while len(self._datasets) > max(self.max_open, 0):
+            self._datasets.popitem(last=False)[1].close()
+
+
+dataset_pool = DatasetPool()
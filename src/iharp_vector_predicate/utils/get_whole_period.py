@@ -1,263 +1,125 @@
+import numpy as np
 import pandas as pd
-import calendar
 
 
-def get_last_date_of_month(dt):
-    return calendar.monthrange(dt.year, dt.month)[1]
+PYRAMID_LEVELS = ["year", "month", "day", "hour"]
+# numpy datetime64 unit of each pyramid level
+EPOCH_HOUR_UNITS = {"year": "Y", "month": "M", "day": "D", "hour": "h"}
 
 
-def get_whole_year_between(start_dt, end_dt):
-    assert start_dt.year <= end_dt.year
-    start_year = start_dt.year
-    end_year = end_dt.year
-    first_hour_start_year = pd.Timestamp(f"{start_year}-01-01 00:00:00")
-    last_hour_end_year = pd.Timestamp(f"{end_year}-12-31 23:00:00")
-    years = list(range(start_year, end_year + 1))
-    if start_dt != first_hour_start_year:
-        years = years[1:]
-    if end_dt != last_hour_end_year:
-        years = years[:-1]
-    # residual
-    residual = []
-    last_hour_start_year = pd.Timestamp(f"{start_year}-12-31 23:00:00")
-    first_hour_end_year = pd.Timestamp(f"{end_year}-01-01 00:00:00")
-    if start_dt != first_hour_start_year and end_dt <= last_hour_start_year:
-        residual.append([start_dt, end_dt])
-    else:
-        if start_dt != first_hour_start_year:
-            residual.append([start_dt, last_hour_start_year])
-        if end_dt < last_hour_end_year:
-            residual.append([first_hour_end_year, end_dt])
-    # print("years:", years)
-    # print("month residual:", residual)
-    return years, residual
-
-
-def get_whole_month_between(start_dt, end_dt):
-    assert start_dt.year == end_dt.year
-    year = start_dt.year
-    start_month = start_dt.month
-    end_month = end_dt.month
-    first_hour_start_month = pd.Timestamp(f"{year}-{start_month:02d}-01 00:00:00")
-    last_hour_end_month = pd.Timestamp(f"{year}-{end_month:02d}-{get_last_date_of_month(end_dt)} 23:00:00")
-    months = [f"{year}-{month:02d}" for month in range(start_month, end_month + 1)]
-    if start_dt != first_hour_start_month:
-        months = months[1:]
-    if end_dt != last_hour_end_month:
-        months = months[:-1]
-    # residual
-    residual = []
-    last_hour_start_month = pd.Timestamp(f"{year}-{start_month:02d}-{get_last_date_of_month(start_dt)} 23:00:00")
-    first_hour_end_month = pd.Timestamp(f"{year}-{end_month:02d}-01 00:00:00")
-    if start_dt != first_hour_start_month and end_dt <= last_hour_start_month:
-        residual.append([start_dt, end_dt])
-    else:
-        if start_dt != first_hour_start_month:
-            residual.append([start_dt, last_hour_start_month])
-        if end_dt < last_hour_end_month:
-            residual.append([first_hour_end_month, end_dt])
-    # print("months:", months)
-    # print("day residual:", residual)
-    return months, residual
-
-
-def get_whole_day_between(start_dt, end_dt):
-    assert start_dt.year == end_dt.year
-    assert start_dt.month == end_dt.month
-    year = start_dt.year
-    month = start_dt.month
-    start_day = start_dt.day
-    end_day = end_dt.day
-    first_hour_start_day = pd.Timestamp(f"{year}-{month:02d}-{start_day:02d} 00:00:00")
-    last_hour_end_day = pd.Timestamp(f"{year}-{month:02d}-{end_day:02d} 23:00:00")
-    days = [f"{year}-{month:02d}-{day:02d}" for day in range(start_day, end_day + 1)]
-    if start_dt != first_hour_start_day:
-        days = days[1:]
-    if end_dt != last_hour_end_day:
-        days = days[:-1]
-    # residual
-    residual = []
-    last_hour_start_day = pd.Timestamp(f"{year}-{month:02d}-{start_day:02d} 23:00:00")
-    first_hour_end_day = pd.Timestamp(f"{year}-{month:02d}-{end_day:02d} 00:00:00")
-    if start_dt != first_hour_start_day and end_dt <= last_hour_start_day:
-        residual.append([start_dt, end_dt])
-    else:
-        if start_dt != first_hour_start_day:
-            residual.append([start_dt, last_hour_start_day])
-        if end_dt < last_hour_end_day:
-            residual.append([first_hour_end_day, end_dt])
-    # print("days:", days)
-    # print("hour residual:", residual)
-    return days, residual
-
-
-def get_whole_hour_between(start_dt, end_dt):
-    assert start_dt.year == end_dt.year
-    assert start_dt.month == end_dt.month
-    assert start_dt.day == end_dt.day
-    year = start_dt.year
-    month = start_dt.month
-    day = start_dt.day
-    start_hour = start_dt.hour
-    end_hour = end_dt.hour
-    hours = [f"{year}-{month:02d}-{day:02d} {hour:02d}:00:00" for hour in range(start_hour, end_hour + 1)]
-    # print("hours:", hours)
-    return hours
-
-
-def get_whole_period_between(start, end):
-    start_dt = pd.Timestamp(start)
-    end_dt = pd.Timestamp(end)
-    whole_months = []
-    whole_days = []
-    whole_hours = []
-    whole_years, residual = get_whole_year_between(start_dt, end_dt)
-    for res in residual:
-        months, residual = get_whole_month_between(pd.Timestamp(res[0]), pd.Timestamp(res[1]))
-        whole_months.extend(months)
-        for res in residual:
-            days, residual = get_whole_day_between(pd.Timestamp(res[0]), pd.Timestamp(res[1]))
-            whole_days.extend(days)
-            for res in residual:
-                hours = get_whole_hour_between(pd.Timestamp(res[0]), pd.Timestamp(res[1]))
-                whole_hours.extend(hours)
-    print("******************")
-    print("whole year")
-    for y in whole_years:
-        print(y)
-    print("whole month")
-    for m in whole_months:
-        print(m)
-    print("whole day")
-    for d in whole_days:
-        print(d)
-    print("whole hour")
-    for h in whole_hours:
-        print(h)
-    return whole_years, whole_months, whole_days, whole_hours
-
-
-def get_whole_ranges_between(start, end):
-    year_range = []
-    month_range = []
-    day_range = []
-    hour_range = []
-    start_dt = pd.Timestamp(start)
-    end_dt = pd.Timestamp(end)
-    whole_years, residual = get_whole_year_between(start_dt, end_dt)
-    if whole_years:
-        year_start = pd.Timestamp(f"{whole_years[0]}-01-01 00:00:00")
-        year_end = pd.Timestamp(f"{whole_years[-1]}-12-31 23:00:00")
-        year_range.append([year_start, year_end])
-    for res in residual:
-        months, residual = get_whole_month_between(pd.Timestamp(res[0]), pd.Timestamp(res[1]))
-        if months:
-            month_start = pd.Timestamp(f"{months[0]}-01 00:00:00")
-            month_end = pd.Timestamp(f"{months[-1]}-{get_last_date_of_month(pd.Timestamp(months[-1]))} 23:00:00")
-            month_range.append([month_start, month_end])
-        for res in residual:
-            days, residual = get_whole_day_between(pd.Timestamp(res[0]), pd.Timestamp(res[1]))
-            if days:
-                day_start = pd.Timestamp(f"{days[0]} 00:00:00")
-                day_end = pd.Timestamp(f"{days[-1]} 23:00:00")
-                day_range.append([day_start, day_end])
-            for res in residual:
-                hour_start = pd.Timestamp(f"{res[0]}")
-                hour_end = pd.Timestamp(f"{res[1]}")
-                hour_range.append([hour_start, hour_end])
-    print("******************")
-    print("year range")
-    for y in year_range:
-        print(y)
-    print("month range")
-    for m in month_range:
-        print(m)
-    print("day range")
-    for d in day_range:
-        print(d)
-    print("hour range")
-    for h in hour_range:
-        print(h)
-    return year_range, month_range, day_range, hour_range
-
-
-def get_total_hours_in_year(year):
-    return 24 * 366 if calendar.isleap(year) else 24 * 365
-
-
-def get_total_hours_in_month(month):
-    return 24 * get_last_date_of_month(pd.Timestamp(month))
-
-
-def get_total_hours_between(start, end):
-    start_dt = pd.to_datetime(start)
-    end_dt = pd.to_datetime(end)
-    return int((end_dt - start_dt) / pd.Timedelta("1 hour")) + 1
+def to_epoch_hours(dt):
+    """
+    Return: int, hours since 1970-01-01 00:00 of dt
+    """
+    return pd.Timestamp(dt).value // 3_600_000_000_000
 
 
-def iterate_months(start_month, end_month):
-    start_month = pd.to_datetime(start_month)
-    end_month = pd.to_datetime(end_month)
-    for n in range((end_month.year - start_month.year) * 12 + end_month.month - start_month.month + 1):
-        yield start_month + pd.DateOffset(months=n)
+def _floor_epoch_hours(hours, unit):
+    # first hour of the period holding each hour
+    return hours.view("datetime64[h]").astype(f"datetime64[{unit}]").astype("datetime64[h]").view(np.int64)
 
 
-def number_of_days_inclusive(start_day, end_day):
-    start_day = pd.to_datetime(start_day)
-    end_day = pd.to_datetime(end_day)
-    return (end_day - start_day).days + 1
+def _ceil_epoch_hours(hours, unit):
+    # first hour of the first period starting at or after each hour
+    periods = (hours - 1).view("datetime64[h]").astype(f"datetime64[{unit}]")
+    return (periods + 1).astype("datetime64[h]").view(np.int64)
 
 
-def number_of_hours_inclusive(start_hour, end_hour):
-    start_hour = pd.to_datetime(start_hour)
-    end_hour = pd.to_datetime(end_hour)
-    return int((end_hour - start_hour) / pd.Timedelta(hours=1)) + 1
+def from_epoch_hours(hours):
+    """
+    Return: str, "YYYY-mm-dd HH:MM:SS" of epoch hours (see to_epoch_hours)
+    """
+    return str(np.datetime64(int(hours), "h").astype("datetime64[s]")).replace("T", " ")
 
 
-def time_array_to_range(time_array, resolution):
+def get_whole_ranges_epoch_hours(start, end):
     """
-    Range: [[pd.Timestamp(start), pd.Timestamp(end)], ...]
+    start, end: epoch hours (see to_epoch_hours), inclusive
+    Decompose [start, end] into whole years, then whole months of the rest, then whole days, then hours.
+    Return: year_range, month_range, day_range, hour_range as int64 arrays of shape (n, 2), inclusive
+        [first, last] epoch hours, in time order within each level
     """
-    # quick fix for single year
-    if resolution == "year" and len(time_array) == 1:
-        single_year = time_array[0]
-        return [[pd.Timestamp(f"{single_year}-01-01 00:00:00"), pd.Timestamp(f"{single_year}-12-31 23:00:00")]]
-
-    if len(time_array) == 0:
-        return []
+    residual = np.array([[start, end]], dtype=np.int64)
+    ranges = []
+    for level in PYRAMID_LEVELS[:-1]:
+        unit = EPOCH_HOUR_UNITS[level]
+        range_start, range_end = residual[:, 0], residual[:, 1]
+        first = _ceil_epoch_hours(range_start, unit)
+        last = _floor_epoch_hours(range_end + 1, unit)
+        whole = first < last
+        whole_range = np.empty((whole.sum(), 2), dtype=np.int64)
+        whole_range[:, 0] = first[whole]
+        whole_range[:, 1] = last[whole] - 1
+        ranges.append(whole_range)
+        # what precedes the whole periods, then what follows them; without whole periods,
+        # the range is cut at the period boundary inside it, if any
+        residual = np.empty((2 * len(range_start), 2), dtype=np.int64)
+        residual[0::2, 0] = range_start
+        residual[0::2, 1] = np.minimum(first, range_end + 1) - 1
+        residual[1::2, 0] = np.maximum(first, last)
+        residual[1::2, 1] = range_end
+        residual = residual[residual[:, 0] <= residual[:, 1]]
+    ranges.append(residual)
+    return tuple(ranges)
+
+
+def _period_starts(start, end, temporal_resolution):
+    """
+    start, end: epoch hours of the first and last hour of whole periods of temporal_resolution
+    Return: int64 array, epoch hour starting each period, then the one following the last period
+    """
+    unit = EPOCH_HOUR_UNITS[temporal_resolution]
+    periods = np.arange(
+        np.datetime64(int(start), "h").astype(f"datetime64[{unit}]"),
+        np.datetime64(int(end), "h").astype(f"datetime64[{unit}]") + 2,
+    )
+    return periods.astype("datetime64[h]").astype(np.int64)
 
-    if resolution == "year":
-        pd_delta = pd.Timedelta(days=366)
-        time_array = [f"{year}-01-01" for year in time_array]
-    elif resolution == "month":
-        pd_delta = pd.Timedelta(days=31)
-    elif resolution == "day":
-        pd_delta = pd.Timedelta(days=1)
-    elif resolution == "hour":
-        pd_delta = pd.Timedelta(hours=1)
 
-    sorted_array = sorted(time_array)
-    time_range = []
-    start = sorted_array[0]
-    start_dt = pd.Timestamp(start)
-    end_dt = start_dt
-    for time in sorted_array[1:]:
-        if pd.Timestamp(time) - end_dt > pd_delta:
-            time_range.append([start_dt, end_dt])
-            start_dt = pd.Timestamp(time)
-        end_dt = pd.Timestamp(time)
-    if start_dt != end_dt:
-        time_range.append([start_dt, end_dt])
+def get_period_hours(start, end, temporal_resolution):
+    """
+    start, end: epoch hours of the first and last hour of whole periods of temporal_resolution
+    Return: int64 array, number of hours of each period
+    """
+    return np.diff(_period_starts(start, end, temporal_resolution))
 
-    # post processing
-    if resolution == "year":
-        for r in time_range:
-            r[1] = pd.Timestamp(f"{r[1].year}-12-31 23:00:00")
-    elif resolution == "month":
-        for r in time_range:
-            r[1] = pd.Timestamp(f"{r[1].year}-{r[1].month}-{get_last_date_of_month(r[1])} 23:00:00")
-    elif resolution == "day":
-        for r in time_range:
-            r[1] = pd.Timestamp(f"{r[1].year}-{r[1].month}-{r[1].day} 23:00:00")
 
-    return time_range
+def get_available_ranges_between(start, end, is_covered):
+    """
+    Decompose as get_whole_ranges_epoch_hours, then check every range against the catalog:
+    is_covered(start, end, temporal_resolution) tells whether pre-aggregated files hold it,
+    start and end given as from_epoch_hours strings.
+    The periods of an uncovered range that are held stay at their level, the others are handed whole to
+    the next finer level (a whole year is whole months, and so on), hours are never checked.
+    Return: year_range, month_range, day_range, hour_range as get_whole_ranges_epoch_hours,
+        adjacent ranges of a level merged
+    """
+    whole_ranges = get_whole_ranges_epoch_hours(to_epoch_hours(start), to_epoch_hours(end))
+    ranges = {level: r.tolist() for level, r in zip(PYRAMID_LEVELS, whole_ranges)}
+    for level, finer in zip(PYRAMID_LEVELS[:-1], PYRAMID_LEVELS[1:]):
+        kept = []
+        for range_start, range_end in ranges[level]:
+            if is_covered(from_epoch_hours(range_start), from_epoch_hours(range_end), level):
+                kept.append([range_start, range_end])
+                continue
+            starts = _period_starts(range_start, range_end, level).tolist()
+            for period_start, next_start in zip(starts[:-1], starts[1:]):
+                if is_covered(from_epoch_hours(period_start), from_epoch_hours(next_start - 1), level):
+                    kept.append([period_start, next_start - 1])
+                else:
+                    ranges[finer].append([period_start, next_start - 1])
+        ranges[level] = kept
+    return tuple(_merge_adjacent_ranges(ranges[level]) for level in PYRAMID_LEVELS)
+
+
+def _merge_adjacent_ranges(ranges):
+    """
+    Return: int64 array (n, 2) of the ranges in time order, ranges following one another merged
+    """
+    merged = []
+    for range_start, range_end in sorted(ranges):
+        if merged and merged[-1][1] + 1 == range_start:
+            merged[-1][1] = range_end
+        else:
+            merged.append([range_start, range_end])
+    return np.array(merged, dtype=np.int64).reshape(-1, 2)
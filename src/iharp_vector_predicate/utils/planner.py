@@ -0,0 +1,131 @@
+import functools
+import math
+import os
+
+import pandas as pd
+
+from ..metadata import ROW_BOX_COLUMNS, TimeAxis
+from .const import get_lat_lon_index_range
+from .dataset_pool import dataset_pool
+
+# one file open is charged as reading this many bytes (open, metadata parse, first chunk seek),
+# files already held by utils.dataset_pool are not opened again and cost nothing
+OPEN_COST_BYTES = 4 * 2**20
+# share of a pruning step (coarser level, baseline rest) expected to be left undecided by the step before it
+PRUNE_UNDECIDED_FRACTION = 0.5
+# bytes per value when the file is not on disk
+DEFAULT_VALUE_BYTES = 4
+
+
+@functools.lru_cache(maxsize=4096)
+def _path_size(path, mtime):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return size
+
+
+def _bytes_per_value(file_path, time_axis, lats, lons):
+    """
+    Return: file size divided by the number of values the file holds
+    """
+    if not os.path.exists(file_path):
+        return DEFAULT_VALUE_BYTES
+    values = time_axis.size * lats * lons
+    if values == 0:
+        return DEFAULT_VALUE_BYTES
+    return _path_size(file_path, os.path.getmtime(file_path)) / values
+
+
+def estimate_read(executor):
+    """
+    executor: GetRasterExecutor (or any executor reading its own bbox and time range)
+    Return: {"bytes": estimated bytes read, "files": {file_path}, "covered": whether local files cover it}
+        bytes are the values selected from every overlapping file times the file's bytes per value
+    """
+    df_overlap, leftover = executor.metadata.query_get_overlap_and_leftover(
+        executor.variable,
+        executor.start_datetime,
+        executor.end_datetime,
+        executor.min_lat,
+        executor.max_lat,
+        executor.min_lon,
+        executor.max_lon,
+        executor.temporal_resolution,
+        executor.spatial_resolution,
+        executor.aggregation,
+    )
+    lat_start, lat_end, lon_start, lon_end = get_lat_lon_index_range(
+        executor.spatial_resolution, executor.min_lat, executor.max_lat, executor.min_lon, executor.max_lon
+    )
+    start = pd.Timestamp(executor.start_datetime)
+    end = pd.Timestamp(executor.end_datetime)
+    total = 0.0
+    # column arrays, row-wise DataFrame iteration would dominate planning on small queries
+    columns = ["file_path", "spatial_resolution", "temporal_resolution"] + ROW_BOX_COLUMNS
+    for file_path, spatial_resolution, temporal_resolution, row_start, row_end, *row_bbox in zip(
+        *(df_overlap[c].to_numpy() for c in columns)
+    ):
+        row_start = pd.Timestamp(row_start)
+        row_end = pd.Timestamp(row_end)
+        row_lat_start, row_lat_end, row_lon_start, row_lon_end = get_lat_lon_index_range(spatial_resolution, *row_bbox)
+        steps = TimeAxis(max(start, row_start), min(end, row_end), temporal_resolution).size
+        lats = max(0, min(lat_end, row_lat_end) - max(lat_start, row_lat_start))
+        lons = max(0, min(lon_end, row_lon_end) - max(lon_start, row_lon_start))
+        bytes_per_value = _bytes_per_value(
+            file_path,
+            TimeAxis(row_start, row_end, temporal_resolution),
+            max(0, row_lat_end - row_lat_start),
+            max(0, row_lon_end - row_lon_start),
+        )
+        total += steps * lats * lons * bytes_per_value
+    return {"bytes": total, "files": set(df_overlap["file_path"]), "covered": leftover is None}
+
+
+def estimate_plan(reads):
+    """
+    reads: [(GetRasterExecutor, expected fraction of it read)]
+    Return: {"bytes", "file_opens", "cost", "feasible"}
+        a file shared by several reads is opened once, and not at all if utils.dataset_pool holds it;
+        cost is bytes + OPEN_COST_BYTES per file open, infinite if a read is not covered by local files
+    """
+    total = 0.0
+    files = {}
+    feasible = True
+    for executor, fraction in reads:
+        estimate = estimate_read(executor)
+        total += fraction * estimate["bytes"]
+        feasible &= estimate["covered"]
+        for f in estimate["files"]:
+            files[f] = max(files.get(f, 0), fraction)
+    file_opens = sum(fraction for f, fraction in files.items() if not dataset_pool.is_open(f))
+    cost = total + OPEN_COST_BYTES * file_opens if feasible else math.inf
+    return {"bytes": total, "file_opens": file_opens, "cost": cost, "feasible": feasible}
+
+
+def choose_plan(plans):
+    """
+    plans: {plan name: reads (see estimate_plan)}, the first plan is the default
+    Return: (name of the cheapest feasible plan, the default when none is, {plan name: estimate})
+    """
+    estimates = {name: estimate_plan(reads) for name, reads in plans.items()}
+    chosen = next(iter(plans))
+    for name, estimate in estimates.items():
+        if estimate["cost"] < estimates[chosen]["cost"]:
+            chosen = name
+    return chosen, estimates
+
+
+def format_plans(title, chosen, estimates):
+    lines = [title]
+    for name, estimate in estimates.items():
+        line = (
+            f"  {'*' if name == chosen else ' '} {name}: {estimate['bytes'] / 2**20:.2f} MiB, "
+            f"{estimate['file_opens']:g} file opens"
+        )
+        if not estimate["feasible"]:
+            line += ", not covered by local files"
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,38 @@
+import numpy as np
+
+
+def decide_from_bounds(filter_predicate, filter_value, mins, maxs):
+    """
+    Decide a predicate for groups of values known only by their min and max:
+        - find >  x: if min >  x, return True ; if max <= x, return False
+        - find <  x: if min >= x, return False; if max <  x, return True
+        - find == x: if min >  x, return False; if max <  x, return False
+        - find >= x: if min >= x, return True ; if max <  x, return False
+        - find <= x: if min >  x, return False; if max <= x, return True
+        - find != x: if min >  x or max < x, return True; if min == max == x, return False
+    Return: int8 array, 1 if the predicate holds for every value within [min, max],
+        0 if it holds for none, -1 if undecided (also when a bound is NaN)
+    """
+    mins = np.asarray(mins, dtype=np.float64)
+    maxs = np.asarray(maxs, dtype=np.float64)
+    false_mask = np.zeros(mins.shape, dtype=bool)
+    true_mask = np.zeros(mins.shape, dtype=bool)
+    if filter_predicate == ">":
+        true_mask, false_mask = mins > filter_value, maxs <= filter_value
+    elif filter_predicate == "<":
+        true_mask, false_mask = maxs < filter_value, mins >= filter_value
+    elif filter_predicate == "==":
+        false_mask = (mins > filter_value) | (maxs < filter_value)
+    elif filter_predicate == ">=":
+        true_mask, false_mask = mins >= filter_value, maxs < filter_value
+    elif filter_predicate == "<=":
+        true_mask, false_mask = maxs <= filter_value, mins > filter_value
+    elif filter_predicate == "!=":
+        true_mask = (mins > filter_value) | (maxs < filter_value)
+        false_mask = (mins == filter_value) & (maxs == filter_value)
+    else:
+        raise ValueError("Invalid filter_predicate")
+    decision = np.full(mins.shape, -1, dtype=np.int8)
+    decision[false_mask] = 0
+    decision[true_mask] = 1
+    return decision
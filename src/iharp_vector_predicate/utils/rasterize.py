@@ -0,0 +1,165 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import shapely
+
+DEFAULT_MAX_MASKS = 256
+# distance (degrees) from a scanline crossing under which a grid point is tested exactly
+_EPS = 1e-9
+
+
+def _edges(geom):
+    """
+    Return: (x0, y0, x1, y1) arrays of the edges of every exterior and interior ring of a (Multi)Polygon
+    """
+    rings = []
+    for polygon in getattr(geom, "geoms", [geom]):
+        rings.append(np.asarray(polygon.exterior.coords))
+        rings.extend(np.asarray(interior.coords) for interior in polygon.interiors)
+    start = np.concatenate([ring[:-1] for ring in rings])
+    end = np.concatenate([ring[1:] for ring in rings])
+    return start[:, 0], start[:, 1], end[:, 0], end[:, 1]
+
+
+def rasterize_polygon(geom, lats, lons):
+    """
+    Scanline rasterization, even-odd rule: a grid point is inside when a ray from it towards -x
+    crosses the rings an odd number of times, and it is not on a ring.
+    Return: bool array (len(lats), len(lons)), grid points inside geom
+    """
+    x0, y0, x1, y1 = _edges(geom)
+    lons = np.asarray(lons)
+    mask = np.zeros((len(lats), len(lons)), dtype=bool)
+    for i, y in enumerate(lats):
+        # half-open in y, so a vertex on the scanline is counted once
+        crossing = (y0 <= y) != (y1 <= y)
+        if not crossing.any():
+            continue
+        cx0, cy0, cx1, cy1 = x0[crossing], y0[crossing], x1[crossing], y1[crossing]
+        xs = np.sort(cx0 + (y - cy0) * (cx1 - cx0) / (cy1 - cy0))
+        pos = xs.searchsorted(lons, side="right")
+        row = pos % 2 == 1
+        # points close to a crossing are decided by the orientation to every crossing edge instead,
+        # exact when vertices and grid points are multiples of the grid step; points on an edge are outside
+        nearest = np.minimum(
+            np.abs(lons - xs[np.clip(pos - 1, 0, len(xs) - 1)]), np.abs(lons - xs[np.clip(pos, 0, len(xs) - 1)])
+        )
+        close = np.flatnonzero(nearest <= _EPS)
+        if close.size > 0:
+            cross = (cx1 - cx0) * (y - cy0) - (cy1 - cy0) * (lons[close, None] - cx0)
+            right_of = cross * np.sign(cy1 - cy0) < 0
+            row[close] = (right_of.sum(axis=1) % 2 == 1) & ~(cross == 0).any(axis=1)
+        # so are vertices and horizontal edges on the scanline
+        row &= ~np.isin(lons, x0[y0 == y])
+        flat = (y0 == y) & (y1 == y)
+        for lo, hi in zip(np.minimum(x0[flat], x1[flat]), np.maximum(x0[flat], x1[flat])):
+            row &= (lons < lo) | (lons > hi)
+        mask[i] = row
+    return mask
+
+
+def coverage_fraction(geom, lats, lons, spatial_resolution):
+    """
+    Return: float array (len(lats), len(lons)), fraction of each cell (centered on its grid point)
+    inside geom. Only cells crossed by the boundary are intersected exactly, the others come from
+    rasterize_polygon
+    """
+    fraction = rasterize_polygon(geom, lats, lons).astype(np.float64).ravel()
+    half = spatial_resolution / 2
+    mesh_lons, mesh_lats = np.meshgrid(lons, lats)
+    cells = shapely.box(
+        mesh_lons.ravel() - half, mesh_lats.ravel() - half, mesh_lons.ravel() + half, mesh_lats.ravel() + half
+    )
+    edge_cells = shapely.STRtree(cells).query(geom.boundary, predicate="intersects")
+    shapely.prepare(geom)
+    fraction[edge_cells] = shapely.area(shapely.intersection(cells[edge_cells], geom)) / spatial_resolution**2
+    return fraction.reshape(len(lats), len(lons))
+
+
+class MaskCache:
+    """
+    Process-wide LRU of polygon masks, keyed by (geometry WKB hash, spatial_resolution, grid points, fractional),
+    so repeated queries over the same region skip the geometry work. Returned arrays are read-only.
+    """
+
+    def __init__(self, max_masks=DEFAULT_MAX_MASKS):
+        self.max_masks = max_masks
+        self.hits = 0
+        self.misses = 0
+        self._masks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, geom, lats, lons, spatial_resolution, fractional=False):
+        """
+        Return: bool mask (see rasterize_polygon), or coverage fractions (see coverage_fraction) if fractional
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        key = (
+            hashlib.sha1(shapely.to_wkb(geom)).hexdigest(),
+            float(spatial_resolution),
+            hashlib.sha1(lats.tobytes() + b"|" + lons.tobytes()).hexdigest(),
+            fractional,
+        )
+        with self._lock:
+            mask = self._masks.get(key)
+            if mask is not None:
+                self._masks.move_to_end(key)
+                self.hits += 1
+                return mask
+
+        if fractional:
+            mask = coverage_fraction(geom, lats, lons, spatial_resolution)
+        else:
+            mask = rasterize_polygon(geom, lats, lons)
+        mask.flags.writeable = False
+        with self._lock:
+            self._masks[key] = mask
+            self.misses += 1
+            while len(self._masks) > max(self.max_masks, 0):
+                self._masks.popitem(last=False)
+        return mask
+
+    def clear(self):
+        with self._lock:
+            self._masks.clear()
+
+
+mask_cache = MaskCache()
+
+
+def plan_reads(mask, min_block=16, min_fill=0.75):
+    """
+    Quadtree over a bool grid mask: a block, shrunk to the rows and columns holding True cells,
+    is read whole when at least min_fill of it is True or no side exceeds min_block cells,
+    otherwise it is split in four.
+    Return: [(row_start, row_end, col_start, col_end)], disjoint half-open rectangles covering every True cell
+    """
+    rectangles = []
+    blocks = [(0, mask.shape[0], 0, mask.shape[1])]
+    while blocks:
+        row_start, row_end, col_start, col_end = blocks.pop()
+        block = mask[row_start:row_end, col_start:col_end]
+        if not block.any():
+            continue
+        rows = np.flatnonzero(block.any(axis=1))
+        cols = np.flatnonzero(block.any(axis=0))
+        row_start, row_end = row_start + rows[0], row_start + rows[-1] + 1
+        col_start, col_end = col_start + cols[0], col_start + cols[-1] + 1
+        block = mask[row_start:row_end, col_start:col_end]
+        if block.mean() >= min_fill or max(block.shape) <= min_block:
+            rectangles.append((row_start, row_end, col_start, col_end))
+            continue
+        row_mid = (row_start + row_end) // 2
+        col_mid = (col_start + col_end) // 2
+        blocks.extend(
+            [
+                (row_start, row_mid, col_start, col_mid),
+                (row_start, row_mid, col_mid, col_end),
+                (row_mid, row_end, col_start, col_mid),
+                (row_mid, row_end, col_mid, col_end),
+            ]
+        )
+    return rectangles
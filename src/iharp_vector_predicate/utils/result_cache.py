@@ -0,0 +1,140 @@
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import xarray as xr
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# configure() argument left unchanged
+_UNSET = object()
+
+
+class ResultCache:
+    """
+    Process-wide cache of executor results.
+
+    Keys are tuples whose first element is (metadata path, metadata mtime), so entries of different
+    versions of a metadata file never meet.
+        - memory tier: LRU bounded by the total nbytes of the cached datasets (max_bytes, 0 disables it)
+        - disk tier: optional, one NetCDF file per entry under cache_dir/<metadata version>/;
+          directories of versions older than the newest one seen for the path are removed
+    Cached data is read-only: put marks the arrays of the dataset unwriteable, and get hands out
+    shallow copies of it (own attrs, shared read-only buffers). Copy a result to modify it in place.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def configure(self, max_bytes=None, cache_dir=_UNSET):
+        """
+        Change the given settings only, cache_dir=None disables the disk tier
+        """
+        with self._lock:
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            if cache_dir is not _UNSET:
+                self.cache_dir = cache_dir
+            self._evict()
+
+    def get(self, key):
+        """
+        Return: cached xarray.Dataset for key, or None
+        """
+        with self._lock:
+            ds = self._entries.get(key)
+            if ds is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return ds.copy(deep=False)
+        path = self._disk_path(key)
+        if path is not None and os.path.exists(path):
+            ds = xr.load_dataset(path)
+            _set_read_only(ds)
+            with self._lock:
+                self.hits += 1
+                self._put_memory(key, ds)
+            return ds.copy(deep=False)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, ds):
+        """
+        ds: computed xarray.Dataset, its arrays are made read-only
+        """
+        _set_read_only(ds)
+        with self._lock:
+            self._remove_older_versions(key[0])
+            self._put_memory(key, ds)
+        path = self._disk_path(key)
+        if path is not None and not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            ds.to_netcdf(tmp_path)
+            os.replace(tmp_path, path)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self._versions.clear()
+
+    def _put_memory(self, key, ds):
+        if ds.nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self._nbytes -= self._entries.pop(key).nbytes
+        self._entries[key] = ds
+        self._nbytes += ds.nbytes
+        self._evict()
+
+    def _evict(self):
+        while self._entries and self._nbytes > self.max_bytes:
+            self._nbytes -= self._entries.popitem(last=False)[1].nbytes
+
+    def _remove_older_versions(self, version):
+        """
+        Remove the disk directories of versions older than version, the first time it is seen;
+        memory entries of older versions are left to the LRU
+        """
+        metadata_path, mtime = version
+        newest = self._versions.get(metadata_path)
+        if newest is not None and newest >= mtime:
+            return
+        self._versions[metadata_path] = mtime
+        if self.cache_dir is not None and os.path.isdir(self.cache_dir):
+            prefix, current_mtime = self._version_dir(version).split("_")
+            for name in os.listdir(self.cache_dir):
+                name_prefix, _, name_mtime = name.partition("_")
+                if name_prefix == prefix and name_mtime.isdigit() and int(name_mtime) < int(current_mtime):
+                    shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+
+    @staticmethod
+    def _version_dir(version):
+        metadata_path, mtime = version
+        return f"{hashlib.sha1(metadata_path.encode()).hexdigest()[:16]}_{int(mtime * 1e6)}"
+
+    def _disk_path(self, key):
+        if self.cache_dir is None:
+            return None
+        file_name = hashlib.sha1(repr(key).encode()).hexdigest() + ".nc"
+        return os.path.join(self.cache_dir, self._version_dir(key[0]), file_name)
+
+
+def _set_read_only(ds):
+    for var in ds.variables.values():
+        if isinstance(var.data, np.ndarray):
+            var.data.flags.writeable = False
+
+
+result_cache = ResultCache()
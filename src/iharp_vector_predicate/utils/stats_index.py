@@ -0,0 +1,261 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from .const import get_lat_lon_index_range, get_lat_lon_range, long_short_name_dict
+from .dataset_pool import dataset_pool
+
+# time buckets of the index, coarsest first, with the numpy datetime64 unit of their periods
+STATS_LEVELS = {"year": "Y", "month": "M", "day": "D"}
+# spatial tiles are TILE_SIZE x TILE_SIZE cells of the 0.25 grid
+TILE_SIZE = 8
+# time steps read at once while building
+_BUILD_TIME_BLOCK = 32
+_COLUMNS = ("time", "min", "max")
+
+
+def get_stats_dir(metadata_path):
+    return os.path.splitext(metadata_path)[0] + "_stats"
+
+
+def _tile_cells(tile_start, n_tiles, grid_len, tile_size):
+    """
+    Return: number of grid cells in each tile, tiles at the end of the grid are cut
+    """
+    first = (tile_start + np.arange(n_tiles)) * tile_size
+    return np.clip(np.minimum(first + tile_size, grid_len) - first, 0, None)
+
+
+def build_stats_index(metadata_path, tile_size=TILE_SIZE):
+    """
+    Build the summary statistics sidecar of a metadata CSV, next to it (see get_stats_dir).
+    For every variable and level of STATS_LEVELS, from the 0.25 pre-aggregated files:
+        - min / max: min of the "min" files and max of the "max" files per (time bucket, tile),
+            NaN where the files do not cover the whole tile
+    Each (variable, level) is a directory of .npy columns, memory-mapped when queried.
+    Source files are assumed not to overlap.
+    """
+    df_meta = pd.read_csv(metadata_path)
+    metadata_mtime = os.path.getmtime(metadata_path)
+    lat_range, lon_range, _ = get_lat_lon_range(0.25)
+    stats_dir = get_stats_dir(metadata_path)
+
+    df_meta = df_meta[(df_meta["spatial_resolution"] == 0.25) & df_meta["temporal_resolution"].isin(STATS_LEVELS)]
+    for (variable, level), df_level in df_meta.groupby(["variable", "temporal_resolution"]):
+        short_name = long_short_name_dict[variable]
+        lat_start, lat_end, lon_start, lon_end = get_lat_lon_index_range(
+            0.25,
+            df_level["min_lat"].min(),
+            df_level["max_lat"].max(),
+            df_level["min_lon"].min(),
+            df_level["max_lon"].max(),
+        )
+        lat_tile_start, lon_tile_start = lat_start // tile_size, lon_start // tile_size
+        n_lat_tiles = (lat_end - 1) // tile_size - lat_tile_start + 1
+        n_lon_tiles = (lon_end - 1) // tile_size - lon_tile_start + 1
+        times = np.unique(
+            np.concatenate([dataset_pool.open(f)["valid_time"].values for f in df_level["file_path"]])
+        )
+        shape = (len(times), n_lat_tiles, n_lon_tiles)
+        columns = {
+            "min": np.full(shape, np.nan),
+            "max": np.full(shape, np.nan),
+        }
+        covered = {"min": np.zeros(shape, dtype=np.int64), "max": np.zeros(shape, dtype=np.int64)}
+
+        for row in df_level.itertuples():
+            if row.aggregation not in ("min", "max"):
+                continue
+            da = dataset_pool.open(row.file_path)[short_name].transpose("valid_time", "latitude", "longitude")
+            lat_idx = np.rint((da["latitude"].values - lat_range[0]) / 0.25).astype(int)
+            lon_idx = np.rint((da["longitude"].values - lon_range[0]) / 0.25).astype(int)
+            lat_order, lon_order = np.argsort(lat_idx), np.argsort(lon_idx)
+            # tile-aligned block holding the file
+            file_lat_tile, file_lon_tile = lat_idx.min() // tile_size, lon_idx.min() // tile_size
+            lat_pad = lat_idx.min() - file_lat_tile * tile_size
+            lon_pad = lon_idx.min() - file_lon_tile * tile_size
+            block_lat_tiles = -(-(lat_pad + len(lat_idx)) // tile_size)
+            block_lon_tiles = -(-(lon_pad + len(lon_idx)) // tile_size)
+            tile_lat_slice = slice(file_lat_tile - lat_tile_start, file_lat_tile - lat_tile_start + block_lat_tiles)
+            tile_lon_slice = slice(file_lon_tile - lon_tile_start, file_lon_tile - lon_tile_start + block_lon_tiles)
+            time_idx = times.searchsorted(da["valid_time"].values)
+
+            for t in range(0, len(time_idx), _BUILD_TIME_BLOCK):
+                values = da[t : t + _BUILD_TIME_BLOCK].values.astype(np.float64)[:, lat_order][:, :, lon_order]
+                block = np.full(
+                    (len(values), block_lat_tiles * tile_size, block_lon_tiles * tile_size), np.nan
+                )
+                block[:, lat_pad : lat_pad + len(lat_idx), lon_pad : lon_pad + len(lon_idx)] = values
+                block = block.reshape(len(values), block_lat_tiles, tile_size, block_lon_tiles, tile_size)
+                target = (time_idx[t : t + _BUILD_TIME_BLOCK], tile_lat_slice, tile_lon_slice)
+                reduce = np.fmin if row.aggregation == "min" else np.fmax
+                columns[row.aggregation][target] = reduce(
+                    columns[row.aggregation][target], reduce.reduce(block, axis=(2, 4))
+                )
+                cells = np.zeros(block.shape[1:], dtype=np.int64)
+                cells.reshape(block_lat_tiles * tile_size, block_lon_tiles * tile_size)[
+                    lat_pad : lat_pad + len(lat_idx), lon_pad : lon_pad + len(lon_idx)
+                ] = 1
+                covered[row.aggregation][target] += cells.sum(axis=(1, 3))
+
+        tile_cells = np.outer(
+            _tile_cells(lat_tile_start, n_lat_tiles, len(lat_range), tile_size),
+            _tile_cells(lon_tile_start, n_lon_tiles, len(lon_range), tile_size),
+        )
+        for method in ("min", "max"):
+            columns[method][covered[method] < tile_cells] = np.nan
+
+        table_dir = os.path.join(stats_dir, f"{variable}_{level}")
+        os.makedirs(table_dir, exist_ok=True)
+        np.save(os.path.join(table_dir, "time.npy"), times)
+        for name, values in columns.items():
+            np.save(os.path.join(table_dir, f"{name}.npy"), values)
+        with open(os.path.join(table_dir, "info.json"), "w") as f:
+            json.dump(
+                {
+                    "metadata_mtime": metadata_mtime,
+                    "tile_size": tile_size,
+                    "lat_tile_start": int(lat_tile_start),
+                    "lon_tile_start": int(lon_tile_start),
+                },
+                f,
+            )
+
+
+class StatsIndex:
+    """
+    Reader of the summary statistics sidecar built by build_stats_index.
+    Bounds are conservative: the min (max) of a bbox or cell is at most (least) its true min (max),
+    and NaN where the index cannot bound it.
+    """
+
+    def __init__(self, stats_dir, metadata_mtime):
+        self.stats_dir = stats_dir
+        self.metadata_mtime = metadata_mtime
+        self._tables = {}
+
+    def _table(self, variable, level):
+        """
+        Return: dict of memory-mapped columns and info, None if missing or built from an older metadata
+        """
+        key = (variable, level)
+        if key not in self._tables:
+            table_dir = os.path.join(self.stats_dir, f"{variable}_{level}")
+            table = None
+            if os.path.isfile(os.path.join(table_dir, "info.json")):
+                with open(os.path.join(table_dir, "info.json")) as f:
+                    table = json.load(f)
+                if table["metadata_mtime"] != self.metadata_mtime:
+                    table = None
+                else:
+                    for name in _COLUMNS:
+                        table[name] = np.load(os.path.join(table_dir, f"{name}.npy"), mmap_mode="r")
+            self._tables[key] = table
+        return self._tables[key]
+
+    def _tile_range(self, table, min_lat, max_lat, min_lon, max_lon):
+        """
+        Return: (lat_slice, lon_slice) of the tiles intersecting the bbox, None if not all are indexed
+        """
+        lat_start, lat_end, lon_start, lon_end = get_lat_lon_index_range(0.25, min_lat, max_lat, min_lon, max_lon)
+        if lat_start >= lat_end or lon_start >= lon_end:
+            return None
+        tile_size = table["tile_size"]
+        lat_lo = lat_start // tile_size - table["lat_tile_start"]
+        lat_hi = (lat_end - 1) // tile_size - table["lat_tile_start"] + 1
+        lon_lo = lon_start // tile_size - table["lon_tile_start"]
+        lon_hi = (lon_end - 1) // tile_size - table["lon_tile_start"] + 1
+        n_lat_tiles, n_lon_tiles = table["min"].shape[1:]
+        if lat_lo < 0 or lon_lo < 0 or lat_hi > n_lat_tiles or lon_hi > n_lon_tiles:
+            return None
+        return slice(lat_lo, lat_hi), slice(lon_lo, lon_hi)
+
+    def period_bounds(self, variable, level, min_lat, max_lat, min_lon, max_lon):
+        """
+        Return: (periods as datetime64[ns] period starts, mins, maxs) of the bbox per time bucket of level,
+            None if the index does not hold the bbox at that level
+        """
+        table = self._table(variable, level)
+        if table is None:
+            return None
+        tiles = self._tile_range(table, min_lat, max_lat, min_lon, max_lon)
+        if tiles is None:
+            return None
+        periods = table["time"].astype(f"datetime64[{STATS_LEVELS[level]}]").astype("datetime64[ns]")
+        mins = np.asarray(table["min"][:, tiles[0], tiles[1]]).min(axis=(1, 2))
+        maxs = np.asarray(table["max"][:, tiles[0], tiles[1]]).max(axis=(1, 2))
+        return periods, mins, maxs
+
+    def cell_bounds(self, variable, start_datetime, end_datetime, spatial_resolution, lats, lons):
+        """
+        lats / lons: ascending cell coordinates on the spatial_resolution grid
+        Return: (mins, maxs) of every cell over the time range, shape (len(lats), len(lons)),
+            from the finest level holding every period the range touches; None if no level does
+        """
+        for level in reversed(list(STATS_LEVELS)):
+            table = self._table(variable, level)
+            if table is None:
+                continue
+            unit = STATS_LEVELS[level]
+            periods = table["time"].astype(f"datetime64[{unit}]")
+            first = np.datetime64(pd.Timestamp(start_datetime).to_datetime64(), unit)
+            last = np.datetime64(pd.Timestamp(end_datetime).to_datetime64(), unit)
+            t_start, t_end = periods.searchsorted(first, side="left"), periods.searchsorted(last, side="right")
+            if t_end - t_start != (last - first).astype(np.int64) + 1:
+                continue
+            tile_size = table["tile_size"]
+            lat_tiles = self._cell_tiles(lats, spatial_resolution, 0, tile_size) - table["lat_tile_start"]
+            lon_tiles = self._cell_tiles(lons, spatial_resolution, 1, tile_size) - table["lon_tile_start"]
+            n_lat_tiles, n_lon_tiles = table["min"].shape[1:]
+            if lat_tiles.min() < 0 or lon_tiles.min() < 0:
+                continue
+            if lat_tiles.max() >= n_lat_tiles or lon_tiles.max() >= n_lon_tiles:
+                continue
+            lat_slice = slice(lat_tiles.min(), lat_tiles.max() + 1)
+            lon_slice = slice(lon_tiles.min(), lon_tiles.max() + 1)
+            tile_mins = np.asarray(table["min"][t_start:t_end, lat_slice, lon_slice]).min(axis=0)
+            tile_maxs = np.asarray(table["max"][t_start:t_end, lat_slice, lon_slice]).max(axis=0)
+            lat_tiles -= lat_slice.start
+            lon_tiles -= lon_slice.start
+            # a cell spans at most two tiles per axis, NaN tile bounds leave it unbounded
+            mins = np.full((len(lats), len(lons)), np.inf)
+            maxs = np.full((len(lats), len(lons)), -np.inf)
+            for lat_tile in lat_tiles:
+                for lon_tile in lon_tiles:
+                    mins = np.minimum(mins, tile_mins[np.ix_(lat_tile, lon_tile)])
+                    maxs = np.maximum(maxs, tile_maxs[np.ix_(lat_tile, lon_tile)])
+            return mins, maxs
+        return None
+
+    @staticmethod
+    def _cell_tiles(values, spatial_resolution, axis, tile_size):
+        """
+        Return: int array of shape (2, len(values)), global tile index of the first and last 0.25 cell
+            covered by each cell
+        A coarse cell covers the 0.25 cells within spatial_resolution / 2 - 0.125 of its center (see utils.const)
+        """
+        grid = get_lat_lon_range(0.25)[axis]
+        half = spatial_resolution / 2 - 0.125
+        first = np.clip(np.rint((values - half - grid[0]) / 0.25).astype(int), 0, len(grid) - 1)
+        last = np.clip(np.rint((values + half - grid[0]) / 0.25).astype(int), 0, len(grid) - 1)
+        return np.stack([first // tile_size, last // tile_size])
+
+
+_stats_index_cache = {}
+
+
+def load_stats_index(metadata):
+    """
+    metadata: Metadata
+    Return: StatsIndex of the metadata sidecar, None if it was not built
+    """
+    stats_dir = get_stats_dir(metadata.f_path)
+    if not os.path.isdir(stats_dir):
+        return None
+    cached = _stats_index_cache.get(metadata.f_path)
+    if cached is None or cached.metadata_mtime != metadata.mtime:
+        cached = StatsIndex(stats_dir, metadata.mtime)
+        _stats_index_cache[metadata.f_path] = cached
+    return cached
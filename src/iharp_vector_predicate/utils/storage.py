@@ -0,0 +1,270 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from xarray.backends import BackendArray
+from xarray.core import indexing
+
+from .const import get_lat_lon_range
+
+# (time, lat-tile, lon-tile) chunking of converted stores, about 4.6 MB of float32 per chunk
+ZARR_CHUNKS = {"valid_time": 720, "latitude": 40, "longitude": 40}
+
+# lat / lon cells per side of a tile store tile: 10 degrees at 0.25, 20 at 0.5, 40 at 1.0
+TILE_CELLS = 40
+
+# encoding keys kept when re-writing a NetCDF variable, the rest is NetCDF storage layout
+_KEPT_ENCODING = ("dtype", "scale_factor", "add_offset", "_FillValue", "units", "calendar")
+
+
+class StorageBackend:
+    """
+    How a file_path from the metadata CSV is opened.
+    open() returns a lazily-indexed xarray.Dataset: selecting from it reads only what is selected.
+    """
+
+    name = None
+
+    def matches(self, path):
+        raise NotImplementedError
+
+    def open(self, path):
+        raise NotImplementedError
+
+    def version(self, path):
+        return os.path.getmtime(path)
+
+
+def _dir_version(path):
+    """
+    Return: latest mtime of the directory store and everything under it,
+        rewriting a chunk touches the chunk file only, not the directories above it
+    """
+    version = os.path.getmtime(path)
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            version = max(version, os.path.getmtime(os.path.join(root, name)))
+    return version
+
+
+class NetCDFBackend(StorageBackend):
+    name = "netcdf"
+
+    def matches(self, path):
+        return True
+
+    def open(self, path):
+        return xr.open_dataset(path, engine="netcdf4")
+
+
+class ZarrBackend(StorageBackend):
+    """
+    Zarr directory store (path ends with .zarr), requires the optional zarr package.
+    A selection only decompresses the chunks it intersects.
+    """
+
+    name = "zarr"
+
+    def matches(self, path):
+        return path.rstrip("/\\").endswith(".zarr")
+
+    def open(self, path):
+        return xr.open_zarr(path, chunks=None)
+
+    def version(self, path):
+        return _dir_version(path)
+
+
+class _TileArray(BackendArray):
+    """
+    (valid_time, latitude, longitude) float32 variable of a tile store, in file order.
+    Indexing loads only the tiles holding the selected cells, each memory-mapped.
+    """
+
+    def __init__(self, var_dir, n_time, lat_cells, lon_cells, tile_cells):
+        self.var_dir = var_dir
+        self.lat_cells = lat_cells  # global grid index of every latitude of the file
+        self.lon_cells = lon_cells
+        self.tile_cells = tile_cells
+        self.shape = (n_time, len(lat_cells), len(lon_cells))
+        self.dtype = np.dtype(np.float32)
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(key, self.shape, indexing.IndexingSupport.OUTER, self._getitem)
+
+    def _getitem(self, key):
+        time_key, lat_key, lon_key = key
+        if isinstance(time_key, (int, np.integer)):
+            time_key = slice(time_key, time_key + 1)
+        lat_pos = np.atleast_1d(np.arange(self.shape[1])[lat_key])
+        lon_pos = np.atleast_1d(np.arange(self.shape[2])[lon_key])
+        n_time = len(range(self.shape[0])[time_key]) if isinstance(time_key, slice) else len(time_key)
+        out = np.full((n_time, len(lat_pos), len(lon_pos)), np.nan, dtype=np.float32)
+        lat_tile, lat_offset = np.divmod(self.lat_cells[lat_pos], self.tile_cells)
+        lon_tile, lon_offset = np.divmod(self.lon_cells[lon_pos], self.tile_cells)
+        for i in np.unique(lat_tile):
+            rows = np.flatnonzero(lat_tile == i)
+            for j in np.unique(lon_tile):
+                cols = np.flatnonzero(lon_tile == j)
+                tile = np.load(os.path.join(self.var_dir, f"{i}_{j}.npy"), mmap_mode="r")
+                out[:, rows[:, None], cols] = tile[time_key][:, lat_offset[rows][:, None], lon_offset[cols]]
+        # integer keys drop their dimension
+        return out[tuple(0 if isinstance(k, (int, np.integer)) else slice(None) for k in key)]
+
+
+def _grid_cells(values, spatial_resolution, axis):
+    """
+    Return: index of every coordinate value on the global grid of spatial_resolution (see utils.const)
+    """
+    grid = get_lat_lon_range(spatial_resolution)[axis]
+    return np.rint((np.asarray(values, dtype=np.float64) - grid[0]) / spatial_resolution).astype(np.int64)
+
+
+class NpyTileBackend(StorageBackend):
+    """
+    Uncompressed tile store (path ends with .npytiles), a directory of:
+        - <data variable>/<i>_<j>.npy: float32 (valid_time, TILE_CELLS, TILE_CELLS) tile i, j of the global
+          lat / lon grid of the file's spatial resolution, cells outside the file are NaN
+        - coords.npz: coordinate values, in file order
+        - attrs.json: dataset and variable attributes, spatial resolution and tile size
+    Tiles of every file of a resolution share boundaries; a selection memory-maps the tiles it intersects only.
+    """
+
+    name = "npytiles"
+
+    def matches(self, path):
+        return path.rstrip("/\\").endswith(".npytiles")
+
+    def open(self, path):
+        with open(os.path.join(path, "attrs.json")) as f:
+            attrs = json.load(f)
+        coords = {}
+        with np.load(os.path.join(path, "coords.npz")) as npz:
+            for name in npz.files:
+                values = npz[name]
+                coords[name] = ((name,) if values.ndim else (), values)
+        lat_cells = _grid_cells(coords["latitude"][1], attrs["spatial_resolution"], 0)
+        lon_cells = _grid_cells(coords["longitude"][1], attrs["spatial_resolution"], 1)
+        data_vars = {}
+        for name, var_attrs in attrs["variables"].items():
+            array = _TileArray(
+                os.path.join(path, name), len(coords["valid_time"][1]), lat_cells, lon_cells, attrs["tile_cells"]
+            )
+            data_vars[name] = xr.Variable(
+                ("valid_time", "latitude", "longitude"), indexing.LazilyIndexedArray(array), attrs=var_attrs
+            )
+        return xr.Dataset(data_vars, coords=coords, attrs=attrs["dataset"])
+
+    def version(self, path):
+        return _dir_version(path)
+
+
+_backends = [ZarrBackend(), NpyTileBackend(), NetCDFBackend()]
+
+
+def register_backend(backend):
+    """
+    backend: StorageBackend, checked before the registered ones
+    """
+    _backends.insert(0, backend)
+
+
+def get_backend(path):
+    for backend in _backends:
+        if backend.matches(path):
+            return backend
+    raise ValueError(f"No storage backend for {path}")
+
+
+def convert_to_zarr(nc_path, zarr_path, chunks=None):
+    """
+    Re-write one NetCDF file as a Zarr directory store chunked by chunks (default ZARR_CHUNKS)
+    """
+    chunks = ZARR_CHUNKS if chunks is None else chunks
+    with xr.open_dataset(nc_path, engine="netcdf4") as ds:
+        ds = ds.chunk({dim: size for dim, size in chunks.items() if dim in ds.dims})
+        for var in ds.variables.values():
+            var.encoding = {k: v for k, v in var.encoding.items() if k in _KEPT_ENCODING}
+        ds.to_zarr(zarr_path, mode="w")
+
+
+def _to_json(value):
+    return value.tolist() if isinstance(value, (np.ndarray, np.generic)) else str(value)
+
+
+def convert_to_npy_tiles(nc_path, tile_path, spatial_resolution, tile_cells=None):
+    """
+    Re-write one NetCDF file of spatial_resolution as an uncompressed float32 tile store (see NpyTileBackend)
+    with tiles of tile_cells x tile_cells cells (default TILE_CELLS)
+    """
+    tile_cells = TILE_CELLS if tile_cells is None else tile_cells
+    os.makedirs(tile_path, exist_ok=True)
+    with xr.open_dataset(nc_path, engine="netcdf4") as ds:
+        ds = ds.transpose("valid_time", "latitude", "longitude")
+        lat_tile, lat_offset = np.divmod(_grid_cells(ds["latitude"].values, spatial_resolution, 0), tile_cells)
+        lon_tile, lon_offset = np.divmod(_grid_cells(ds["longitude"].values, spatial_resolution, 1), tile_cells)
+        for name, var in ds.data_vars.items():
+            values = var.values.astype(np.float32)
+            os.makedirs(os.path.join(tile_path, name), exist_ok=True)
+            for i in np.unique(lat_tile):
+                rows = np.flatnonzero(lat_tile == i)
+                for j in np.unique(lon_tile):
+                    cols = np.flatnonzero(lon_tile == j)
+                    tile = np.full((len(values), tile_cells, tile_cells), np.nan, dtype=np.float32)
+                    tile[:, lat_offset[rows][:, None], lon_offset[cols]] = values[:, rows[:, None], cols]
+                    np.save(os.path.join(tile_path, name, f"{i}_{j}.npy"), tile)
+        np.savez(os.path.join(tile_path, "coords.npz"), **{name: coord.values for name, coord in ds.coords.items()})
+        attrs = {
+            "dataset": ds.attrs,
+            "variables": {name: var.attrs for name, var in ds.data_vars.items()},
+            "spatial_resolution": float(spatial_resolution),
+            "tile_cells": int(tile_cells),
+        }
+        with open(os.path.join(tile_path, "attrs.json"), "w") as f:
+            json.dump(attrs, f, default=_to_json)
+
+
+def _convert_metadata(metadata_path, out_metadata_path, out_dir, convert, suffix, temporal_resolutions=None):
+    df_meta = pd.read_csv(metadata_path)
+    os.makedirs(out_dir, exist_ok=True)
+    file_paths = []
+    for row in df_meta.itertuples():
+        if temporal_resolutions is not None and row.temporal_resolution not in temporal_resolutions:
+            file_paths.append(row.file_path)
+            continue
+        out_path = os.path.join(out_dir, os.path.splitext(os.path.basename(row.file_path))[0] + suffix)
+        convert(row, out_path)
+        file_paths.append(out_path)
+    df_meta["file_path"] = file_paths
+    df_meta.to_csv(out_metadata_path, index=False)
+
+
+def convert_metadata_to_zarr(metadata_path, out_metadata_path, out_dir, chunks=None):
+    """
+    Convert every file listed in a metadata CSV to Zarr under out_dir,
+    and write a copy of the metadata pointing to the converted stores
+    """
+    _convert_metadata(
+        metadata_path,
+        out_metadata_path,
+        out_dir,
+        lambda row, out_path: convert_to_zarr(row.file_path, out_path, chunks),
+        ".zarr",
+    )
+
+
+def convert_metadata_to_npy_tiles(metadata_path, out_metadata_path, out_dir, temporal_resolutions=("year", "month")):
+    """
+    Convert the files of the given temporal resolutions (the levels hit by every heatmap / find-time query)
+    to tile stores under out_dir, and write a copy of the metadata pointing to them
+    """
+    _convert_metadata(
+        metadata_path,
+        out_metadata_path,
+        out_dir,
+        lambda row, out_path: convert_to_npy_tiles(row.file_path, out_path, row.spatial_resolution),
+        ".npytiles",
+        temporal_resolutions,
+    )
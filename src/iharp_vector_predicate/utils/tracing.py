@@ -0,0 +1,179 @@
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+DEFAULT_MAX_TRACES = 64
+# counters summed per stage in Span.summary
+COUNTERS = ("bytes", "files", "cells_decided")
+
+
+class Span:
+    """
+    One traced stage: name, wall time, attributes (counters such as bytes, files, cells_decided
+    and descriptive values) and the spans opened inside it.
+    """
+
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.seconds = None
+        self.children = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, **counters):
+        with self._lock:
+            for key, value in counters.items():
+                self.attrs[key] = self.attrs.get(key, 0) + value
+
+    def _add_child(self, span):
+        with self._lock:
+            self.children.append(span)
+
+    def _finish(self):
+        self.seconds = time.perf_counter() - self._start
+
+    def walk(self):
+        yield self
+        for child in list(self.children):
+            yield from child.walk()
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "seconds": self.seconds,
+            "attrs": self.attrs,
+            "children": [child.to_dict() for child in list(self.children)],
+        }
+
+    def summary(self):
+        """
+        Return: {"seconds": wall time of the span, "stages": {stage name: {"count", "seconds", counters}}}
+            stage seconds add up nested spans of the same name, and concurrent ones, as they ran
+        """
+        stages = {}
+        for span in self.walk():
+            if span is self:
+                continue
+            stage = stages.setdefault(span.name, {"count": 0, "seconds": 0.0})
+            stage["count"] += 1
+            stage["seconds"] += span.seconds or 0.0
+            for counter in COUNTERS:
+                if counter in span.attrs:
+                    stage[counter] = stage.get(counter, 0) + span.attrs[counter]
+        return {"seconds": self.seconds, "stages": stages}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), default=str, **kwargs)
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Return: Span rebuilt from to_dict(), e.g. one recorded in a worker process
+        """
+        span = cls(d["name"], **d["attrs"])
+        span.seconds = d["seconds"]
+        span.children = [cls.from_dict(child) for child in d["children"]]
+        return span
+
+
+class Tracer:
+    """
+    Process-wide recorder of spans. A span opened while another is open in the same thread becomes
+    its child; a span opened with none open is the root of a new trace, the last max_traces are kept.
+    Work handed to a thread pool joins the submitting span through bind; spans recorded in other processes
+    join it through attach.
+    """
+
+    def __init__(self, max_traces=DEFAULT_MAX_TRACES):
+        self.enabled = True
+        self.traces = deque(maxlen=max_traces)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def current(self):
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """
+        Yield: Span, recorded when the block exits (a detached one when tracing is disabled)
+        """
+        span = Span(name, **attrs)
+        if not self.enabled:
+            yield span
+            return
+        parent = self.current()
+        if parent is not None:
+            parent._add_child(span)
+        stack = self._stack()
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            stack.pop()
+            span._finish()
+            if parent is None:
+                with self._lock:
+                    self.traces.append(span)
+
+    def bind(self, fn):
+        """
+        Return: fn running under the span open here, for use from another thread
+        """
+        parent = self.current()
+
+        def bound(*args, **kwargs):
+            if parent is None:
+                return fn(*args, **kwargs)
+            stack = self._stack()
+            stack.append(parent)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                stack.pop()
+
+        return bound
+
+    def attach(self, span):
+        """
+        Add span, recorded elsewhere, as a child of the span open here
+        """
+        parent = self.current()
+        if self.enabled and parent is not None:
+            parent._add_child(span)
+
+    def last(self):
+        with self._lock:
+            return self.traces[-1] if self.traces else None
+
+    def export_json(self, path=None, **kwargs):
+        """
+        Return: JSON list of the kept traces, also written to path if given
+        """
+        with self._lock:
+            traces = [span.to_dict() for span in self.traces]
+        text = json.dumps(traces, default=str, **kwargs)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(text)
+        return text
+
+    def clear(self):
+        with self._lock:
+            self.traces.clear()
+
+
+tracer = Tracer()
@@ -0,0 +1,113 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from iharp_vector_predicate.utils.dataset_pool import dataset_pool
+from iharp_vector_predicate.utils.result_cache import result_cache
+
+VARIABLE = "2m_temperature"
+# the synthetic catalog: hourly 0.25 data over 2 x 2 degrees for 2020, and its pre-aggregates
+MIN_LAT, MAX_LAT, MIN_LON, MAX_LON = 60.0, 62.0, -30.0, -28.0
+START, END = "2020-01-01 00:00:00", "2020-12-31 23:00:00"
+_RESAMPLE_FREQ = {"day": "D", "month": "ME", "year": "YE"}
+
+
+def _coarsen(ds, spatial_resolution, aggregation):
+    """
+    Return: ds on the spatial_resolution grid, a coarse cell aggregating the 0.25 points around its center
+    """
+    if spatial_resolution == 0.25:
+        return ds
+    factor = int(spatial_resolution / 0.25)
+    ascending = ds.sel(latitude=slice(MAX_LAT - 0.25, MIN_LAT)).isel(latitude=slice(None, None, -1))
+    ascending = ascending.sel(longitude=slice(MIN_LON, MAX_LON - 0.25))
+    coarse = getattr(ascending.coarsen(latitude=factor, longitude=factor, boundary="trim"), aggregation)()
+    return coarse.isel(latitude=slice(None, None, -1))
+
+
+def _write_catalog(data_dir):
+    rng = np.random.default_rng(0)
+    lats = np.arange(MAX_LAT, MIN_LAT - 0.125, -0.25)
+    lons = np.arange(MIN_LON, MAX_LON + 0.125, 0.25)
+    times = pd.date_range(START, END, freq="h")
+    values = (
+        260
+        + 10 * np.sin(np.arange(len(times)) / len(times) * 2 * np.pi)[:, None, None]
+        + (lats[None, :, None] - MIN_LAT)
+        + rng.normal(0, 2, (len(times), len(lats), len(lons)))
+    )
+    raw = xr.Dataset(
+        {"t2m": (["valid_time", "latitude", "longitude"], values.astype("float32"))},
+        coords={"valid_time": times, "latitude": lats, "longitude": lons},
+    )
+
+    rows = []
+
+    def save(ds, temporal_resolution, spatial_resolution, aggregation):
+        path = os.path.join(data_dir, f"{VARIABLE}_{spatial_resolution}_{temporal_resolution}_{aggregation}.nc")
+        ds.to_netcdf(path)
+        rows.append(
+            {
+                "variable": VARIABLE,
+                "start_datetime": START,
+                "end_datetime": END,
+                "min_lat": float(ds["latitude"].min()),
+                "max_lat": float(ds["latitude"].max()),
+                "min_lon": float(ds["longitude"].min()),
+                "max_lon": float(ds["longitude"].max()),
+                "temporal_resolution": temporal_resolution,
+                "spatial_resolution": spatial_resolution,
+                "aggregation": aggregation,
+                "file_path": path,
+            }
+        )
+
+    save(raw, "hour", 0.25, "none")
+    for aggregation in ("mean", "max", "min"):
+        for temporal_resolution in ("hour", "day", "month", "year"):
+            if temporal_resolution == "hour":
+                resampled = raw
+            else:
+                resampled = getattr(raw.resample(valid_time=_RESAMPLE_FREQ[temporal_resolution]), aggregation)()
+            for spatial_resolution in (0.25, 0.5, 1.0):
+                if temporal_resolution == "hour" and spatial_resolution == 0.25:
+                    continue
+                save(
+                    _coarsen(resampled, spatial_resolution, aggregation),
+                    temporal_resolution,
+                    spatial_resolution,
+                    aggregation,
+                )
+    return pd.DataFrame(rows)
+
+
+@pytest.fixture(scope="session")
+def catalog(tmp_path_factory):
+    """
+    Return: pd.DataFrame of the synthetic catalog, written once per session with its NetCDF files
+    """
+    return _write_catalog(str(tmp_path_factory.mktemp("data")))
+
+
+@pytest.fixture
+def metadata_path(catalog, tmp_path):
+    """
+    Return: path of a metadata CSV of the synthetic catalog, private to the test
+    """
+    path = str(tmp_path / "metadata.csv")
+    catalog.to_csv(path, index=False)
+    return path
+
+
+@pytest.fixture(autouse=True)
+def _clear_caches():
+    result_cache.clear()
+    yield
+    result_cache.clear()
+    dataset_pool.clear()
@@ -0,0 +1,53 @@
+import json
+
+import xarray as xr
+
+from iharp_vector_predicate import BatchExecutor, FindTimeExecutor, TimeseriesExecutor
+from iharp_vector_predicate.utils.result_cache import result_cache
+
+from conftest import VARIABLE
+
+
+def _queries(metadata_path):
+    def timeseries(start, end, bbox, temporal_resolution="hour", method="mean"):
+        aggregation = "none" if temporal_resolution == "hour" else "mean"
+        return TimeseriesExecutor(
+            VARIABLE, start, end, *bbox, temporal_resolution, aggregation, method, metadata=metadata_path
+        )
+
+    return [
+        # overlapping boxes, read through their envelope
+        timeseries("2020-05-01 00:00:00", "2020-05-03 23:00:00", (60, 61.5, -30, -28.5)),
+        timeseries("2020-05-02 00:00:00", "2020-05-04 23:00:00", (60.5, 62, -29.5, -28), method=["max", "min"]),
+        # long thin boxes, whose envelope is mostly outside them
+        timeseries("2020-06-01 00:00:00", "2020-06-03 23:00:00", (60, 60.25, -30, -28), method="max"),
+        timeseries("2020-06-01 00:00:00", "2020-06-03 23:00:00", (60, 62, -30, -29.75), method="max"),
+        timeseries("2020-07-01 00:00:00", "2020-07-20 23:00:00", (60.5, 61.5, -29.5, -28.5), "day", "count"),
+        FindTimeExecutor(
+            VARIABLE, "2020-05-01 00:00:00", "2020-05-03 23:00:00", 60, 61.5, -30, -28.5, "hour", "mean", "mean",
+            ">", 261.0, metadata=metadata_path,
+        ),
+        # the same time series as the first query
+        timeseries("2020-05-01 00:00:00", "2020-05-03 23:00:00", (60, 61.5, -30, -28.5)),
+    ]
+
+
+def test_batch_equals_individual_runs(metadata_path):
+    batch = BatchExecutor(_queries(metadata_path)).execute()
+    result_cache.clear()
+    single = [query.execute() for query in _queries(metadata_path)]
+    assert len(batch) == len(single)
+    for batch_result, single_result in zip(batch, single):
+        assert "stages" in json.loads(batch_result.attrs["trace"])
+        xr.testing.assert_allclose(batch_result.drop_attrs(), single_result.drop_attrs())
+
+
+def test_batch_serves_and_fills_result_cache(metadata_path):
+    queries = _queries(metadata_path)
+    first = queries[0].execute()
+    batch = BatchExecutor(queries).execute()
+    xr.testing.assert_identical(batch[0].drop_attrs(), first.drop_attrs())
+    hits = result_cache.hits
+    for query in _queries(metadata_path):
+        query.execute()
+    assert result_cache.hits == hits + len(queries)
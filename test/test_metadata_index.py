@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+
+from iharp_vector_predicate.metadata import MetadataIndex, load_metadata
+
+PARTITION = ("2m_temperature", "hour", 0.25, "none")
+
+
+def _tiled_catalog():
+    """
+    Monthly 1 x 2 degree tiles over 40 x 40 degrees for two years, plus rows spanning both years
+    """
+    rows = []
+    for month in pd.date_range("2020-01-01", "2021-12-01", freq="MS"):
+        end = month + pd.offsets.MonthEnd(0) + pd.Timedelta(hours=23)
+        for lat in range(40):
+            for lon in range(0, 40, 2):
+                rows.append((str(month), str(end), lat, lat + 0.75, lon, lon + 1.75))
+    for lat in range(20):
+        rows.append(("2020-01-01 00:00:00", "2021-12-31 23:00:00", lat, lat + 0.75, 0, 0.75))
+    df = pd.DataFrame(rows, columns=["start_datetime", "end_datetime", "min_lat", "max_lat", "min_lon", "max_lon"])
+    for column, value in zip(MetadataIndex.PARTITION_COLUMNS, PARTITION):
+        df[column] = value
+    return df
+
+
+def _brute_force(df, start, end, min_lat, max_lat, min_lon, max_lon):
+    starts = pd.to_datetime(df["start_datetime"])
+    ends = pd.to_datetime(df["end_datetime"])
+    hit = (
+        (starts <= end)
+        & (ends >= start)
+        & (df["min_lat"] <= max_lat)
+        & (df["max_lat"] >= min_lat)
+        & (df["min_lon"] <= max_lon)
+        & (df["max_lon"] >= min_lon)
+    )
+    return np.flatnonzero(hit.to_numpy())
+
+
+def test_query_matches_brute_force_and_tests_few_boxes():
+    df = _tiled_catalog()
+    index = MetadataIndex(df)
+    part = index.partitions[PARTITION]
+    rng = np.random.default_rng(0)
+    for _ in range(100):
+        start = pd.Timestamp("2020-01-01") + pd.Timedelta(days=int(rng.integers(0, 700)))
+        end = start + pd.Timedelta(days=int(rng.integers(0, 40)))
+        min_lat, min_lon = rng.uniform(-2, 40, size=2)
+        bbox = (min_lat, min_lat + rng.uniform(0, 4), min_lon, min_lon + rng.uniform(0, 4))
+        positions = index.query(PARTITION[0], start, end, *bbox, *PARTITION[1:])
+        np.testing.assert_array_equal(positions, _brute_force(df, start, end, *bbox))
+        # a few nodes per level and the rows of the leaves they reach, not a scan of the partition
+        _, tested = index._search(part, start.value, end.value, *bbox)
+        assert tested < len(df) / 20
+
+
+def test_query_other_partition_and_empty_catalog():
+    df = _tiled_catalog()
+    index = MetadataIndex(df)
+    assert len(index.query("2m_temperature", "2020-01-01", "2020-01-02", 0, 1, 0, 1, "day", 0.25, "mean")) == 0
+    empty = MetadataIndex(df.iloc[:0])
+    assert len(empty.query(*PARTITION[:1], "2020-01-01", "2020-01-02", 0, 1, 0, 1, *PARTITION[1:])) == 0
+
+
+def test_overlap_and_leftover(tmp_path):
+    df = pd.DataFrame(
+        [
+            ("2020-01-01 00:00:00", "2020-06-30 23:00:00", 60.0, 62.0, -30.0, -28.0),
+            ("2020-07-01 00:00:00", "2020-12-31 23:00:00", 60.0, 61.0, -30.0, -28.0),
+        ],
+        columns=["start_datetime", "end_datetime", "min_lat", "max_lat", "min_lon", "max_lon"],
+    )
+    for column, value in zip(MetadataIndex.PARTITION_COLUMNS, PARTITION):
+        df[column] = value
+    df["file_path"] = ["first.nc", "second.nc"]
+    path = tmp_path / "metadata.csv"
+    df.to_csv(path, index=False)
+    metadata = load_metadata(str(path))
+
+    # the second half of the year lacks the rows above 61
+    overlap, leftover = metadata.query_get_overlap_and_leftover(
+        PARTITION[0], "2020-06-30 00:00:00", "2020-07-01 23:00:00", 60, 62, -30, -28, *PARTITION[1:]
+    )
+    assert list(overlap["file_path"]) == ["first.nc", "second.nc"]
+    assert leftover == [
+        {
+            "start_datetime": pd.Timestamp("2020-07-01 00:00:00"),
+            "end_datetime": pd.Timestamp("2020-07-01 23:00:00"),
+            "min_lat": 61.25,
+            "max_lat": 62.0,
+            "min_lon": -30.0,
+            "max_lon": -28.0,
+        }
+    ]
+
+    overlap, leftover = metadata.query_get_overlap_and_leftover(
+        PARTITION[0], "2020-07-01 00:00:00", "2020-07-01 23:00:00", 60, 61, -29, -28, *PARTITION[1:]
+    )
+    assert list(overlap["file_path"]) == ["second.nc"]
+    assert leftover is None
+
+    overlap, leftover = metadata.query_get_overlap_and_leftover(
+        PARTITION[0], "2021-01-01 00:00:00", "2021-01-01 23:00:00", 60, 61, -29, -28, *PARTITION[1:]
+    )
+    assert overlap.empty
+    assert len(leftover) == 1 and leftover[0]["start_datetime"] == pd.Timestamp("2021-01-01 00:00:00")
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+import iharp_vector_predicate.query_executor as query_executor
+from iharp_vector_predicate import FindAreaExecutor, FindTimeExecutor
+from iharp_vector_predicate.utils.planner import choose_plan
+
+from conftest import VARIABLE
+
+
+def _prefer_pyramid(plans):
+    chosen, estimates = choose_plan(plans)
+    if "pyramid" in estimates and estimates["pyramid"]["feasible"]:
+        chosen = "pyramid"
+    return chosen, estimates
+
+
+@pytest.fixture(autouse=True)
+def _force_pyramid(monkeypatch):
+    # the synthetic files are too small for the cost model to tell the plans apart, run the pyramids
+    monkeypatch.setattr(query_executor, "choose_plan", _prefer_pyramid)
+
+
+@pytest.mark.parametrize(
+    "temporal_resolution, method, predicate, value",
+    [
+        ("hour", "max", ">", 268.0),
+        ("hour", "min", "<", 252.0),
+        ("hour", "mean", ">=", 261.0),
+        ("day", "max", "<=", 266.0),
+        ("day", "mean", "<", 261.0),
+        ("month", "min", "<", 250.0),
+    ],
+)
+def test_find_time_pyramid_equals_baseline(metadata_path, temporal_resolution, method, predicate, value):
+    start, end = "2020-02-01 00:00:00", "2020-11-30 23:00:00"
+    executor = FindTimeExecutor(
+        VARIABLE, start, end, 60.25, 61.75, -29.75, -28.25, temporal_resolution, method, method, predicate, value,
+        metadata=metadata_path,
+    )
+    assert executor._choose_plan() == "pyramid"
+    result = executor.execute()
+    baseline = executor._execute_baseline(start, end)
+    np.testing.assert_array_equal(result["valid_time"].values, baseline["valid_time"].values)
+    np.testing.assert_array_equal(result["t2m"].values, baseline["t2m"].values)
+
+
+@pytest.mark.parametrize(
+    "spatial_resolution, method, predicate, value",
+    [
+        (0.25, "max", ">", 279.0),
+        (0.25, "min", "<", 243.0),
+        (0.25, "mean", ">=", 261.0),
+        (0.5, "max", "<=", 278.0),
+        (0.5, "mean", ">", 261.25),
+    ],
+)
+def test_find_area_pyramid_equals_baseline(metadata_path, spatial_resolution, method, predicate, value):
+    executor = FindAreaExecutor(
+        VARIABLE, "2020-03-15 05:00:00", "2020-10-10 17:00:00", 60, 62, -30, -28, spatial_resolution, method,
+        method, predicate, value, metadata=metadata_path,
+    )
+    assert executor._choose_plan() == "pyramid"
+    result = executor.execute()
+    baseline = executor._execute_baseline(executor.min_lat, executor.max_lat, executor.min_lon, executor.max_lon)
+    baseline = baseline["t2m"].transpose("latitude", "longitude")
+    np.testing.assert_allclose(result["latitude"].values, baseline["latitude"].values)
+    np.testing.assert_allclose(result["longitude"].values, baseline["longitude"].values)
+    np.testing.assert_array_equal(result["t2m"].values, baseline.values)
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+import shapely
+
+from iharp_vector_predicate.utils.rasterize import coverage_fraction, mask_cache, plan_reads, rasterize_polygon
+
+LATS = np.arange(70, 59.9, -0.25)
+LONS = np.arange(-40, -29.9, 0.25)
+
+
+def _random_polygon(rng, snap):
+    """
+    Return: star-shaped polygon around a random center, its vertices on the grid if snap
+    """
+    center = rng.uniform([-37, 62], [-33, 68])
+    angles = np.sort(rng.uniform(0, 2 * np.pi, int(rng.integers(3, 12))))
+    radii = rng.uniform(0.5, 3, len(angles))
+    points = center + np.column_stack([np.cos(angles), np.sin(angles)]) * radii[:, None]
+    if snap:
+        points = np.round(points * 4) / 4
+    return shapely.Polygon(points).buffer(0)
+
+
+def _geometries():
+    rng = np.random.default_rng(0)
+    geometries = [_random_polygon(rng, snap=i % 2 == 0) for i in range(40)]
+    # holes, grid-aligned edges and vertices, several parts
+    geometries.append(shapely.box(-38, 61, -32, 67).difference(shapely.box(-36, 63, -34, 65)))
+    geometries.append(shapely.Polygon([(-38, 61), (-35, 67), (-32, 61), (-35, 64)]))
+    geometries.append(shapely.MultiPolygon([shapely.box(-39, 61, -37, 63), shapely.box(-34.1, 64.1, -31.3, 68.9)]))
+    return [g for g in geometries if not g.is_empty and g.geom_type in ("Polygon", "MultiPolygon")]
+
+
+@pytest.mark.parametrize("geom", _geometries())
+def test_rasterize_polygon_matches_shapely(geom):
+    mesh_lons, mesh_lats = np.meshgrid(LONS, LATS)
+    # points on the boundary are outside, as shapely's contains
+    np.testing.assert_array_equal(rasterize_polygon(geom, LATS, LONS), shapely.contains_xy(geom, mesh_lons, mesh_lats))
+
+
+@pytest.mark.parametrize("geom", _geometries()[::5])
+def test_coverage_fraction_matches_shapely(geom):
+    half = 0.125
+    mesh_lons, mesh_lats = np.meshgrid(LONS, LATS)
+    cells = shapely.box(mesh_lons - half, mesh_lats - half, mesh_lons + half, mesh_lats + half)
+    expected = shapely.area(shapely.intersection(cells, geom)) / 0.25**2
+    np.testing.assert_allclose(coverage_fraction(geom, LATS, LONS, 0.25), expected, atol=1e-9)
+
+
+def test_mask_cache_returns_read_only_masks():
+    geom = shapely.box(-38, 61, -32, 67)
+    mask = mask_cache.get(geom, LATS, LONS, 0.25)
+    assert mask_cache.get(geom, LATS, LONS, 0.25) is mask
+    assert not mask.flags.writeable
+
+
+def test_plan_reads_covers_mask_with_disjoint_rectangles():
+    for geom in _geometries():
+        mask = rasterize_polygon(geom, LATS, LONS)
+        covered = np.zeros(mask.shape, dtype=int)
+        for row_start, row_end, col_start, col_end in plan_reads(mask):
+            covered[row_start:row_end, col_start:col_end] += 1
+        assert covered.max() <= 1
+        assert covered[mask].all()
@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from iharp_vector_predicate import TimeseriesExecutor
+from iharp_vector_predicate.utils.result_cache import result_cache
+
+from conftest import VARIABLE
+
+
+def _query(metadata_path):
+    return TimeseriesExecutor(
+        VARIABLE, "2020-03-01 00:00:00", "2020-03-31 23:00:00", 60, 61, -30, -29, "day", "mean", "mean",
+        metadata=metadata_path,
+    )
+
+
+def test_result_cache_hit_is_read_only(metadata_path):
+    first = _query(metadata_path).execute()
+    hits = result_cache.hits
+    second = _query(metadata_path).execute()
+    assert result_cache.hits == hits + 1
+    xr.testing.assert_identical(first.drop_attrs(), second.drop_attrs())
+    assert not second["t2m"].values.flags.writeable
+
+
+def test_result_cache_invalidated_by_metadata_change(metadata_path, tmp_path):
+    before = _query(metadata_path).execute()
+
+    # point the day / 0.25 / mean row at a shifted copy of its file, the metadata mtime moves forward
+    df = pd.read_csv(metadata_path)
+    row = (df["temporal_resolution"] == "day") & (df["spatial_resolution"] == 0.25) & (df["aggregation"] == "mean")
+    shifted_path = str(tmp_path / "shifted.nc")
+    with xr.open_dataset(df.loc[row, "file_path"].item()) as ds:
+        (ds + 1).to_netcdf(shifted_path)
+    df.loc[row, "file_path"] = shifted_path
+    mtime = os.path.getmtime(metadata_path)
+    df.to_csv(metadata_path, index=False)
+    os.utime(metadata_path, (mtime + 10, mtime + 10))
+
+    misses = result_cache.misses
+    after = _query(metadata_path).execute()
+    assert result_cache.misses == misses + 1
+    np.testing.assert_allclose(after["t2m"].values, before["t2m"].values + 1, rtol=1e-6)